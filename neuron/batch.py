@@ -0,0 +1,135 @@
+from .decoder import decode, match_brackets
+from .engine import bad_pointer, load, tape_reach
+from .tape import cell_mask, tape_size
+from .tape_indices import TapeIndices
+
+import numpy as np
+
+
+class BatchBrainfuckRuntime:
+    # runs one program over many inputs at once, keeping a row of a 2-D array per lane. All lanes
+    # step through the program together; a loop keeps running for as long as any lane is still in
+    # it, with the lanes that left it masked out.
+    def __init__(self, declaration_mapper, source, static_data, symbol_table, cell_bits=None):
+        self.declaration_mapper = declaration_mapper
+        self.source = source
+        self.static_data = static_data
+        self.symbol_table = symbol_table
+        self.mask = cell_mask(cell_bits)
+
+        self.tapes = None
+        self.pointers = None
+        self.outputs = None
+
+    def ensure_tape_size(self, lanes):
+        size = self.pointers[lanes].max(initial=0) + self.reach + 1
+        if size > self.tapes.shape[1]:
+            padding = np.zeros((self.tapes.shape[0], size - self.tapes.shape[1]), dtype=self.tapes.dtype)
+            self.tapes = np.concatenate([self.tapes, padding], axis=1)
+
+    def read_input(self, lanes):
+        # lanes that have read all of their input get zeroes
+        values = np.zeros(len(lanes), dtype=np.int64)
+        for n, lane in enumerate(lanes):
+            position = self.input_positions[lane]
+            if position < len(self.inputs[lane]):
+                values[n] = ord(self.inputs[lane][position])
+                self.input_positions[lane] += 1
+
+        return values
+
+    def run_range(self, start_pc, end_pc, lanes):
+        pc = start_pc
+        while pc < end_pc:
+            instruction = self.instructions[pc]
+            op = instruction.op
+
+            if op == '[':
+                loop_end_pc = self.jumps[pc]
+                looping = lanes
+                while True:
+                    looping = looping[self.tapes[looping, self.pointers[looping]] != 0]
+                    if len(looping) == 0:
+                        break
+
+                    self.run_range(pc + 1, loop_end_pc, looping)
+
+                pc = loop_end_pc + 1
+                continue
+
+            elif op == '>':
+                self.pointers[lanes] += instruction.count
+                if self.pointers[lanes].min(initial=0) < 0:
+                    raise bad_pointer(self.pointers[lanes].min(), instruction)
+                self.ensure_tape_size(lanes)
+
+            elif op == 'scan':
+                moving = lanes
+                while True:
+                    moving = moving[self.tapes[moving, self.pointers[moving]] != 0]
+                    if len(moving) == 0:
+                        break
+
+                    self.pointers[moving] += instruction.count
+                    if self.pointers[moving].min() < 0:
+                        raise bad_pointer(self.pointers[moving].min(), instruction)
+                    self.ensure_tape_size(moving)
+
+            else:
+                cells = self.pointers[lanes] + instruction.offset
+                if cells.min(initial=0) < 0:
+                    raise bad_pointer(cells.min(), instruction)
+
+                if op == '+':
+                    self.tapes[lanes, cells] = (self.tapes[lanes, cells] + instruction.count) & self.mask
+
+                elif op == 'clear':
+                    self.tapes[lanes, cells] = 0
+
+                elif op == 'transfer':
+                    values = self.tapes[lanes, cells]
+                    for target, factor in instruction.args:
+                        if (cells + target).min(initial=0) < 0:
+                            raise bad_pointer((cells + target).min(), instruction)
+
+                        self.tapes[lanes, cells + target] = (self.tapes[lanes, cells + target] + values * factor) & self.mask
+                    self.tapes[lanes, cells] = 0
+
+                elif op == '.':
+                    for lane, value in zip(lanes, self.tapes[lanes, cells]):
+                        self.outputs[lane].append(chr(value) * instruction.count)
+
+                elif op == ',':
+                    for i in range(instruction.count):
+                        self.tapes[lanes, cells] = self.read_input(lanes) & self.mask
+
+                else:
+                    raise Exception('Unknown instruction {}'.format(instruction))
+
+            pc += 1
+
+    def execute(self, code, inputs):
+        self.instructions = load(decode(code))
+        self.jumps = match_brackets(self.instructions)
+        self.reach = tape_reach(self.instructions)
+
+        self.inputs = list(inputs)
+        self.input_positions = [0] * len(self.inputs)
+        self.outputs = [[] for i in self.inputs]
+
+        self.tapes = np.zeros((len(self.inputs), tape_size(self.static_data)), dtype=np.int64)
+        self.pointers = np.zeros(len(self.inputs), dtype=np.int64)
+
+        lanes = np.arange(len(self.inputs))
+        self.ensure_tape_size(lanes)
+        self.run_range(0, len(self.instructions), lanes)
+
+        self.outputs = [''.join(output) for output in self.outputs]
+
+    def get_declaration_values(self, declaration_name):
+        declaration = self.declaration_mapper[declaration_name]
+        return self.tapes[:, TapeIndices.START_STACK + declaration.position]
+
+    def get_array_values(self, declaration_name, offset):
+        declaration = self.declaration_mapper[declaration_name]
+        return self.tapes[:, TapeIndices.START_STACK + declaration.position + offset * 3]
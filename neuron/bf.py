@@ -1,27 +1,43 @@
 from .console import BackgroundColor, TextColor, bold_text, colored_text, colored_text_background
+from .decoder import decode, match_brackets
+from .codegen import compile_code, compile_loop
+from .engine import bad_pointer, profile, read_input_char, run
+from .tape import cell_mask, new_tape, tape_size
 from .visitor import TapeIndices
 
-from collections import namedtuple
+from collections import deque, namedtuple
 from pprint import pprint
-import copy
 import re
 import sys
 
 
 class State:
-    def __init__(self, index, op_start_index, instr_count, number, tape, pointer, output):
+    def __init__(self, pc, index, op_start_index, instr_count, tape, pointer, output):
+        self.pc = pc
         self.index = index
         self.op_start_index = op_start_index
         self.instr_count = instr_count
-        self.number = number
         self.tape = tape
         self.pointer = pointer
         self.output = output
 
 
+# what executing a single instruction changed, so that it can be undone; changes holds the
+# (tape index, old value) pairs of every cell the instruction wrote
+Step = namedtuple('Step', ['pc', 'index', 'op_start_index', 'instr_count', 'pointer', 'output_length',
+                           'changes'])
+
+
 class BrainfuckRuntime:
-    def __init__(self, declaration_mapper, source, static_data, symbol_table, print_tape_sections=True):
-        self.states = []
+    def __init__(self, declaration_mapper, source, static_data, symbol_table, print_tape_sections=True,
+                 history_size=1000, hot_loop_threshold=50, cell_bits=None):
+        self.state = None
+        self.cell_bits = cell_bits
+        self.mask = cell_mask(cell_bits)
+        self.history = deque(maxlen=history_size)
+        self.hot_loop_threshold = hot_loop_threshold
+        self.loop_counts = {}
+        self.native_loops = {}
         self.source = source
         self.static_data = static_data
         self.symbol_table = symbol_table
@@ -100,7 +116,7 @@ class BrainfuckRuntime:
                              ('ip', [TapeIndices.START_IP_WORKSPACE, TapeIndices.END_IP_WORKSPACE]),
                              ('stack', [TapeIndices.START_STACK, TapeIndices.END_STACK]),
                              ('lvalues', [TapeIndices.START_LVALUES, TapeIndices.END_LVALUES]),
-                             ('static', [TapeIndices.START_STATIC_SEGMENT, len(self.states[0].tape) - 1])]
+                             ('static', [TapeIndices.START_STATIC_SEGMENT, len(self.state.tape) - 1])]
         else:
             tape_sections = []
 
@@ -162,7 +178,7 @@ class BrainfuckRuntime:
             section_line = section_line.ljust(section_name[1]) + section_name[0]
 
         print(prefix + ' ' * 5 + mark_line)
-        print('{}{}{}'.format(prefix, '({}) '.format(self.states[0].pointer).ljust(5), colored_tape))
+        print('{}{}{}'.format(prefix, '({}) '.format(self.state.pointer).ljust(5), colored_tape))
 
         if self.print_tape_sections:
             print(prefix + ' ' * 5 + lvalue_line)
@@ -179,12 +195,12 @@ class BrainfuckRuntime:
 
             size = mapped_declaration.declaration.size
             if size == 1:
-                value = self.states[0].tape[tape_position]
+                value = self.state.tape[tape_position]
             else:
                 value = '{{{}}}'.format(', '.join([str(state.tape[tape_position + 3*i]) for i in range(size)]))
 
             line = '{}{}{}'.format('[{}] '.format(tape_position).rjust(5), padded_name, value)
-            if self.states[0].pointer == tape_position:
+            if self.state.pointer == tape_position:
                 line = colored_text_background(BackgroundColor.LIGHT_MAGENTA, TextColor.BLACK, line)
             print(line)
 
@@ -208,16 +224,86 @@ class BrainfuckRuntime:
     def get_declaration_value(self, declaration_name):
         declaration = self.declaration_mapper[declaration_name]
         tape_position = TapeIndices.START_STACK + declaration.position
-        return self.states[0].tape[tape_position]
+        return self.state.tape[tape_position]
 
     def get_array_value(self, declaration_name, offset):
         declaration = self.declaration_mapper[declaration_name]
         tape_position = TapeIndices.START_STACK + declaration.position + offset * 3
-        return self.states[0].tape[tape_position]
+        return self.state.tape[tape_position]
+
+    def profile_declarations(self, code):
+        # runs the program, returning how many of the instructions executed touched each
+        # declaration's cells; BrainfuckCompilerVisitor.to_bf(placement=...) lays out the next
+        # compilation of the program by these
+        state = self.new_state()
+        self.state = state
+        state.pointer, state.output, cell_counts = profile(decode(code), state.tape, mask=self.mask)
+        state.index = len(code)
+        state.op_start_index = len(code)
+
+        use_counts = {}
+        for name, declaration in self.declaration_mapper.positions.items():
+            tape_position = TapeIndices.START_STACK + declaration.position
+            use_counts[name] = sum([cell_counts[tape_position + 3*i] for i in range(declaration.declaration.size)])
+
+        return use_counts
 
     def index_in_breakpoint(self, index):
         return any([index >= b_start_index and index <= b_end_index for b_start_index, b_end_index in self.breakpoints])
 
+    def range_has_breakpoint(self, start_index, end_index):
+        return any([b_start_index <= end_index and b_end_index >= start_index
+                    for b_start_index, b_end_index in self.breakpoints])
+
+    def get_native_loop(self, instructions, jumps, pc):
+        # counts how often the loop starting at pc has been entered, and once it's hot, compiles it
+        # to Python so that it can run without going through the interpreter. The compiled loop
+        # hands control back at breakpoints and I/O. Loops the debugger has a breakpoint set in are
+        # always interpreted.
+        count = self.loop_counts.get(pc, 0) + 1
+        self.loop_counts[pc] = count
+        if count < self.hot_loop_threshold:
+            return None
+
+        loop = instructions[pc:jumps[pc]+1]
+        if self.range_has_breakpoint(loop[0].start, loop[-1].index):
+            return None
+
+        if pc not in self.native_loops:
+            self.native_loops[pc] = compile_loop(loop, self.mask)
+
+        return self.native_loops[pc]
+
+    def run_native_loop(self, native_loop, state):
+        # returns the position in the code to carry on interpreting from inside the loop, or None if
+        # the loop ran to completion
+        changes = []
+        self.history.append(Step(pc=state.pc, index=state.index, op_start_index=state.op_start_index,
+                                 instr_count=state.instr_count, pointer=state.pointer,
+                                 output_length=len(state.output), changes=changes))
+
+        state.pointer, exit_pc, old = native_loop(state.tape, state.pointer)
+
+        changes.extend((i, value) for i, value in old.items() if state.tape[i] != value)
+        self.modified_indices.extend(i for i, value in changes)
+
+        state.instr_count += 1
+        return None if exit_pc is None else state.pc + exit_pc
+
+    def undo_step(self):
+        state = self.state
+        step = self.history.pop()
+
+        for tape_index, value in reversed(step.changes):
+            state.tape[tape_index] = value
+
+        state.pc = step.pc
+        state.index = step.index
+        state.op_start_index = step.op_start_index
+        state.instr_count = step.instr_count
+        state.pointer = step.pointer
+        state.output = state.output[:step.output_length]
+
     def get_closing_bracket_index(self, code, index):
         stack = 1
         while stack > 0:
@@ -246,162 +332,195 @@ class BrainfuckRuntime:
 
         return index
 
+    def new_state(self):
+        tape = new_tape(tape_size(self.static_data), self.cell_bits)
+        return State(pc=0, index=0, op_start_index=0, instr_count=0, tape=tape, pointer=0, output='')
+
     def execute(self, code, debug=False, start_break=False):
+        instructions = decode(code)
+        jumps = match_brackets(instructions)
+
         step_into = start_break
         step_over = False
         step_over_start = None
         prompt_once = False
-        comment = False
-        color_code = False
         previous_input_line = 's' if start_break else 'c'
         skip_breakpoints = not debug
 
-        tape = [0] * (TapeIndices.START_STATIC_SEGMENT + 16)
-        state = State(index=0, op_start_index=0, instr_count=0, number=None, tape=tape, pointer=0, output='')
-        self.states.insert(0, state)
-
-        while state.index < len(code):
-            if state.pointer < 0:
-                raise Exception("Bad tape pointer: {} at index {}".format(state.pointer, state.index))
-
-            op = code[state.index]
-
-            if op == '{':
-                comment = True
-            elif op == '}':
-                comment = False
-            elif op == '\033':
-                color_code = True
-            elif color_code and op == 'm':
-                color_code = False
-            elif not comment and not color_code:
-                if op == '!' and not skip_breakpoints:
+        state = self.new_state()
+        self.state = state
+        self.history.clear()
+        self.loop_counts = {}
+        self.native_loops = {}
+
+        # nothing can stop the program or look at its intermediate states, so skip straight to the
+        # end with the headless engine
+        if not debug and not start_break and len(self.breakpoints) == 0:
+            state.pointer, state.output, state.instr_count = run(instructions, state.tape, mask=self.mask)
+            state.pc = len(instructions)
+            state.index = len(code)
+            state.op_start_index = len(code)
+            return
+
+        while state.pc < len(instructions):
+            instruction = instructions[state.pc]
+            op = instruction.op
+            state.index = instruction.index
+            state.op_start_index = instruction.start
+
+            if op == '!':
+                if not skip_breakpoints:
                     step_into = True
-                    state.op_start_index = state.index + 1
 
-                elif ord(op) in range(ord('0'), ord('9') + 1):
-                    digit = ord(op) - ord('0')
-                    if state.number is None:
-                        state.number = digit
+                state.pc += 1
+                continue
+
+            get_input_line = ((step_into or step_over) and step_over_start == None) or self.index_in_breakpoint(state.index) or prompt_once
+
+            if get_input_line:
+                if debug:
+                    self.print_state(state, code)
+
+                prompt_once = False
+                line = input()
+                if len(line) == 0:
+                    line = previous_input_line
+                previous_input_line = line
+
+                command = line[0] if len(line) > 0 else ''
+                if len(command) > 0 and command in 'csnr': # the empty string is a substring of any string
+                    self.modified_indices = []
+
+                    step_into = False
+                    step_over = False
+                    if command == 'c':
+                        pass
+                    elif command == 's':
+                        step_into = True
+                    elif command == 'n':
+                        step_over = True
+                    elif command == 'r':
+                        skip_breakpoints = True
+                    else:
+                        raise Exception('Accidentally captured command {}'.format(command))
+
+                elif command == 'S':
+                    if len(self.history) == 0:
+                        print('Reached beginning of state history')
                     else:
-                        state.number = state.number*10 + digit
-
-                elif op in '+-><.,[]':
-                    get_input_line = ((step_into or step_over) and step_over_start == None) or self.index_in_breakpoint(state.index) or prompt_once
-
-                    if get_input_line:
-                        if debug:
-                            self.print_state(state, code)
-
-                        prompt_once = False
-                        line = input()
-                        if len(line) == 0:
-                            line = previous_input_line
-                        previous_input_line = line
-
-                        command = line[0] if len(line) > 0 else ''
-                        if len(command) > 0 and command in 'csnr': # the empty string is a substring of any string
-                            self.modified_indices = []
-
-                            step_into = False
-                            step_over = False
-                            if command == 'c':
-                                pass
-                            elif command == 's':
-                                step_into = True
-                            elif command == 'n':
-                                step_over = True
-                            elif command == 'r':
-                                skip_breakpoints = True
-                            else:
-                                raise Exception('Accidentally captured command {}'.format(command))
-
-                        elif command == 'S':
-                            if len(self.states) == 1:
-                                print('Reached beginning of state history')
-                            else:
-                                self.states.pop(0)
-                                self.modified_indices = []
-                                state = self.states[0]
-
-                            prompt_once = True
-                            continue
-
-                        elif command == 'b':
-                            breakpoint = (state.op_start_index, state.index)
-                            if self.index_in_breakpoint(state.index):
-                                self.breakpoints.remove(breakpoint)
-                            else:
-                                self.breakpoints.append(breakpoint)
-
-                            prompt_once = True
-                            continue
-
-                        elif command == 'q':
-                            sys.exit(0)
-
-                        else:
-                            print('Unrecognized command "{}"'.format(command))
-                            prompt_once = True
-                            continue
-
-                    state = copy.deepcopy(state)
-                    self.states.insert(0, state)
-                    self.states = self.states[:1000]
-
-                    count = 1 if state.number is None else state.number
-                    for i in range(count):
-                        if op == '+':
-                            state.tape[state.pointer] += 1
-                            if not get_input_line:
-                                self.modified_indices.append(state.pointer)
-
-                        elif op == '-':
-                            state.tape[state.pointer] -= 1
-                            if not get_input_line:
-                                self.modified_indices.append(state.pointer)
-
-                        elif op == '>':
-                            state.pointer += 1
-                            if state.pointer == len(state.tape):
-                                state.tape.append(0)
-
-                        elif op == '<':
-                            state.pointer -= 1
-
-                        elif op == '.':
-                            value = chr(state.tape[state.pointer])
-                            state.output += value
-
-                        elif op == ',':
-                            line = ''
-                            while len(line) == 0:
-                                print('> ', end='')
-                                line = input()
-
-                            state.tape[state.pointer] = ord(line[0])
-
-                        elif op == '[':
-                            if state.tape[state.pointer] == 0:
-                                if step_over_start == state.index:
-                                    step_over_start = None
-
-                                state.index = self.get_closing_bracket_index(code, state.index)
-
-                            elif step_over and step_over_start == None:
-                                step_over_start = state.index
-
-                        elif op == ']':
-                            state.index = self.get_opening_bracket_index(code, state.index) - 1
-
-                    state.instr_count += 1
-                    state.number = None
-                    state.op_start_index = state.index + 1
+                        self.undo_step()
+                        self.modified_indices = []
+
+                    prompt_once = True
+                    continue
+
+                elif command == 'b':
+                    breakpoint = (state.op_start_index, state.index)
+                    if self.index_in_breakpoint(state.index):
+                        self.breakpoints.remove(breakpoint)
+                    else:
+                        self.breakpoints.append(breakpoint)
+
+                    prompt_once = True
+                    continue
+
+                elif command == 'q':
+                    sys.exit(0)
 
                 else:
-                    state.op_start_index = state.index + 1
+                    print('Unrecognized command "{}"'.format(command))
+                    prompt_once = True
+                    continue
+
+            elif op == '[':
+                # a hot loop runs natively, up to any breakpoint or I/O in it
+                native_loop = self.get_native_loop(instructions, jumps, state.pc)
+                if native_loop is not None:
+                    exit_pc = self.run_native_loop(native_loop, state)
+                    if exit_pc is not None:
+                        state.pc = exit_pc
+                        continue
+
+                    if step_over_start == state.index:
+                        step_over_start = None
+
+                    state.pc = jumps[state.pc] + 1
+                    continue
+
+            changes = []
+            self.history.append(Step(pc=state.pc, index=state.index, op_start_index=state.op_start_index,
+                                     instr_count=state.instr_count, pointer=state.pointer,
+                                     output_length=len(state.output), changes=changes))
+
+            # none of these move the pointer, so the cell's value before the first repetition is all
+            # that's needed to undo them
+            if op in '+-,':
+                changes.append((state.pointer, state.tape[state.pointer]))
+
+            for i in range(instruction.count):
+                if op == '+':
+                    state.tape[state.pointer] = (state.tape[state.pointer] + 1) & self.mask
+                    if not get_input_line:
+                        self.modified_indices.append(state.pointer)
+
+                elif op == '-':
+                    state.tape[state.pointer] = (state.tape[state.pointer] - 1) & self.mask
+                    if not get_input_line:
+                        self.modified_indices.append(state.pointer)
+
+                elif op == '>':
+                    state.pointer += 1
+                    if state.pointer == len(state.tape):
+                        state.tape.append(0)
+
+                elif op == '<':
+                    state.pointer -= 1
+
+                elif op == '.':
+                    value = chr(state.tape[state.pointer])
+                    state.output += value
+
+                elif op == ',':
+                    state.tape[state.pointer] = read_input_char() & self.mask
+
+                elif op == '[':
+                    if state.tape[state.pointer] == 0:
+                        if step_over_start == state.index:
+                            step_over_start = None
+
+                        state.pc = jumps[state.pc]
+
+                    elif step_over and step_over_start == None:
+                        step_over_start = state.index
+
+                elif op == ']':
+                    state.pc = jumps[state.pc] - 1
+
+            # the pointer is reported at the instruction that moved it off the tape
+            if state.pointer < 0:
+                raise bad_pointer(state.pointer, instruction)
 
-            state.index += 1
+            state.instr_count += 1
+            state.pc += 1
+
+        # leave the final state pointing just past the end of the code, after the last instruction
+        state.index = len(code)
+        state.op_start_index = len(code)
 
         if debug:
             self.print_state(state, code)
+
+
+class CompiledBrainfuckRuntime(BrainfuckRuntime):
+    def execute(self, code, debug=False, start_break=False):
+        if debug or start_break:
+            raise Exception('Compiled programs cannot be debugged, use BrainfuckRuntime instead')
+
+        program = compile_code(code, self.mask)
+
+        state = self.new_state()
+        state.pointer, state.output = program(state.tape)
+        state.index = len(code)
+        state.op_start_index = len(code)
+        state.instr_count = None
+        self.state = state
@@ -0,0 +1,198 @@
+from .decoder import decode, match_brackets
+from .engine import bad_pointer, load, read_input_char, tape_reach
+
+from functools import lru_cache
+
+
+# CPython refuses to compile more than 20 statically nested blocks, so loops nested deeper than this
+# are split out into functions of their own
+MAX_NESTED_LOOPS = 16
+
+
+class LoopExit(Exception):
+    # raised by a loop from compile_loop when it reaches an instruction the debugger runs itself
+    def __init__(self, pointer, pc):
+        self.pointer = pointer
+        self.pc = pc
+
+
+class PythonGenerator:
+    # exit_pcs, if given, maps the index of every instruction to its position in the debugger's
+    # instruction stream. The code then stops at breakpoints and I/O, raising a LoopExit with that
+    # position, and keeps the old value of every cell it writes in old.
+    def __init__(self, instructions, mask=-1, exit_pcs=None):
+        self.instructions = instructions
+        self.mask = mask
+        self.exit_pcs = exit_pcs
+        self.jumps = match_brackets(instructions)
+        self.reach = tape_reach(instructions)
+        self.functions = []
+
+    def cell(self, offset):
+        if offset == 0:
+            return 'p'
+        return 'p + {}'.format(offset) if offset > 0 else 'p - {}'.format(-offset)
+
+    def record(self, lines, indent, cell):
+        if self.exit_pcs is not None:
+            lines.append('{}if {} not in old: old[{}] = tape[{}]'.format(indent, cell, cell, cell))
+
+    def add(self, indent, cell, amount):
+        # unbounded cells don't need masking
+        if self.mask == -1:
+            return '{}tape[{}] += {}'.format(indent, cell, amount)
+        return '{}tape[{}] = (tape[{}] + {}) & {}'.format(indent, cell, cell, amount, self.mask)
+
+    def check_offset(self, lines, indent, offset, pc):
+        if offset < 0:
+            lines.append('{}if p < {}: raise bad_pointer({}, instructions[{}])'.format(
+                indent, -offset, self.cell(offset), pc))
+
+    def check_pointer(self, lines, indent, direction, pc):
+        if direction < 0:
+            lines.append('{}if p < 0: raise bad_pointer(p, instructions[{}])'.format(indent, pc))
+        else:
+            lines.append('{}if p + {} >= len(tape): tape.extend([0] * (p + {} - len(tape) + 1))'.format(
+                indent, self.reach, self.reach))
+
+    def generate_range(self, start_pc, end_pc, depth, lines):
+        indent = '    ' * (depth + 1)
+        pc = start_pc
+
+        while pc < end_pc:
+            instruction = self.instructions[pc]
+            op = instruction.op
+            cell = self.cell(instruction.offset)
+
+            if op == '[':
+                loop_end_pc = self.jumps[pc]
+
+                if depth + 1 >= MAX_NESTED_LOOPS:
+                    name = self.generate_function(pc, loop_end_pc + 1)
+                    lines.append('{}p = {}(tape, p, out, old)'.format(indent, name))
+                else:
+                    lines.append('{}while tape[p]:'.format(indent))
+                    body_start = len(lines)
+                    self.generate_range(pc + 1, loop_end_pc, depth + 1, lines)
+                    if len(lines) == body_start:
+                        lines.append('{}    pass'.format(indent))
+
+                pc = loop_end_pc + 1
+                continue
+
+            elif op in '!.,' and self.exit_pcs is not None:
+                lines.append('{}raise LoopExit({}, {})'.format(indent, cell, self.exit_pcs[instruction.index]))
+
+            elif op == '+':
+                self.check_offset(lines, indent, instruction.offset, pc)
+                self.record(lines, indent, cell)
+                lines.append(self.add(indent, cell, instruction.count))
+
+            elif op == '>':
+                lines.append('{}p += {}'.format(indent, instruction.count))
+                self.check_pointer(lines, indent, instruction.count, pc)
+
+            elif op == 'clear':
+                self.check_offset(lines, indent, instruction.offset, pc)
+                self.record(lines, indent, cell)
+                lines.append('{}tape[{}] = 0'.format(indent, cell))
+
+            elif op == 'transfer':
+                lowest_offset = min([0] + [target for target, factor in instruction.args])
+                self.check_offset(lines, indent, instruction.offset + lowest_offset, pc)
+                lines.append('{}v = tape[{}]'.format(indent, cell))
+                lines.append('{}if v:'.format(indent))
+                for target, factor in instruction.args:
+                    target_cell = self.cell(instruction.offset + target)
+                    self.record(lines, indent + '    ', target_cell)
+                    lines.append(self.add(indent + '    ', target_cell, 'v * {}'.format(factor)))
+                self.record(lines, indent + '    ', cell)
+                lines.append('{}    tape[{}] = 0'.format(indent, cell))
+
+            elif op == 'scan':
+                lines.append('{}while tape[p]:'.format(indent))
+                lines.append('{}    p += {}'.format(indent, instruction.count))
+                self.check_pointer(lines, indent + '    ', instruction.count, pc)
+
+            elif op == '.':
+                self.check_offset(lines, indent, instruction.offset, pc)
+                lines.append('{}out.append(chr(tape[{}]) * {})'.format(indent, cell, instruction.count))
+
+            elif op == ',':
+                self.check_offset(lines, indent, instruction.offset, pc)
+                for i in range(instruction.count):
+                    lines.append('{}tape[{}] = read_input_char() & {}'.format(indent, cell, self.mask))
+
+            else:
+                raise Exception('Unknown instruction {}'.format(instruction))
+
+            pc += 1
+
+    def generate_function(self, start_pc, end_pc, prologue=[]):
+        name = 'block_{}'.format(len(self.functions))
+        lines = ['def {}(tape, p, out, old):'.format(name)] + prologue
+        # the placeholder keeps this function's position ahead of any it calls being appended later
+        self.functions.append(None)
+        index = len(self.functions) - 1
+
+        self.generate_range(start_pc, end_pc, 0, lines)
+        lines.append('    return p')
+        self.functions[index] = '\n'.join(lines)
+        return name
+
+    def generate(self):
+        prologue = []
+        self.check_pointer(prologue, '    ', 1, None)
+        main_name = self.generate_function(0, len(self.instructions), prologue)
+        return '\n\n'.join(self.functions), main_name
+
+
+def generate_python(instructions, mask=-1, exit_pcs=None):
+    return PythonGenerator(instructions, mask, exit_pcs).generate()
+
+
+def exec_python(instructions, mask=-1, exit_pcs=None):
+    # the generated code reports bad pointers with the instruction they happened at
+    source, main_name = generate_python(instructions, mask, exit_pcs)
+    namespace = {'bad_pointer': bad_pointer, 'read_input_char': read_input_char, 'LoopExit': LoopExit,
+                 'instructions': instructions}
+    exec(compile(source, '<bf>', 'exec'), namespace)
+    return namespace[main_name]
+
+
+def compile_instructions(instructions, mask=-1):
+    # returns a function taking a tape and a pointer, which runs the instructions over them and
+    # returns the final pointer and output
+    main = exec_python(load(instructions), mask)
+
+    def program(tape, pointer=0):
+        out = []
+        pointer = main(tape, pointer, out, None)
+        return pointer, ''.join(out)
+
+    return program
+
+
+def compile_loop(instructions, mask=-1):
+    # for the debugger: returns a function taking a tape and a pointer, which runs the instructions
+    # over them until they finish or reach a breakpoint or I/O. It returns the final pointer, the
+    # position in instructions to carry on from, or None if they finished, and the old values of
+    # the cells it wrote.
+    exit_pcs = dict((instruction.index, pc) for pc, instruction in enumerate(instructions))
+    main = exec_python(load(instructions, breakpoints=True), mask, exit_pcs)
+
+    def loop(tape, pointer):
+        old = {}
+        try:
+            return main(tape, pointer, [], old), None, old
+        except LoopExit as loop_exit:
+            return loop_exit.pointer, loop_exit.pc, old
+
+    return loop
+
+
+@lru_cache(maxsize=16)
+def compile_code(code, mask=-1):
+    # turns the whole program into Python source with a while loop per BF loop, so running it
+    # doesn't dispatch on every instruction
+    return compile_instructions(decode(code), mask)
@@ -1,266 +1,474 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from pycparser import c_ast
 
-from .console import colored_text, TextColor
+from .ir import Breakpoint, Change, Loop, Marker, Read, Shift, Write, at, clear, render, travel
 from .tape_indices import TapeIndices
 
 
-def bf_travel(from_pos, to_pos, opposite=False):
-    distance = abs(to_pos - from_pos)
-    if opposite:
-        direction = '<' if to_pos > from_pos else '>'
-    else:
-        direction = '>' if to_pos > from_pos else '<'
-
-    return '{}{}'.format(distance, direction)
-
-
 def addressable_offset(declaration_mapper, name):
     position = declaration_mapper[name].position
     return ((position - 2) - (TapeIndices.START_ADDRESSABLE_MEMORY - TapeIndices.START_STACK)) // 3
 
 
-bf_start_paren = colored_text(TextColor.LIGHT_GRAY, '(')
-bf_end_paren = colored_text(TextColor.LIGHT_GRAY, ')')
+def is_temp(name):
+    return type(name) == str and '~' in name
 
 
-def format_bf_name(name):
-    return colored_text(TextColor.LIGHT_GREEN, name)
-
+def commandtuple(name, fields):
+    # read_fields, consumed_fields and written_fields name the fields of cells the command reads and
+    # leaves as they were, reads and leaves zeroed, and writes to. transferred_fields are consumed
+    # when they name a temp, and only read when they name a variable, which the command copies
+    # rather than moves. scratch_size is the number of cells from the stack_index the command is
+    # rendered at that it uses as scratch space.
+    def transferred(self, temps):
+        return [getattr(self, field) for field in self.transferred_fields
+                if is_temp(getattr(self, field)) == temps]
 
-def format_bf(name, attrs_object, *bf):
-    fields = []
-    if attrs_object != None:
-        fields = ['{}{}{}'.format(colored_text(TextColor.LIGHT_GRAY, name),
-                                  colored_text(TextColor.LIGHT_GRAY, '='),
-                                  colored_text(TextColor.LIGHT_YELLOW, getattr(attrs_object, name)))
-                  for name in attrs_object._fields if name != 'coord']
+    def reads(self):
+        return [getattr(self, field) for field in self.read_fields] + transferred(self, False)
 
-    formatted_fields = ''
-    if len(fields) > 0:
-        formatted_fields = ' {}{}{}'.format(
-            colored_text(TextColor.LIGHT_GRAY, '{'),
-            ', '.join(fields) if len(fields) > 0 else '',
-            colored_text(TextColor.LIGHT_GRAY, '}'))
+    def consumes(self):
+        return [getattr(self, field) for field in self.consumed_fields] + transferred(self, True)
 
-    return '{}{}{} {}{}'.format(
-        bf_start_paren,
-        format_bf_name(name),
-        formatted_fields,
-        bf[0].format(*bf[1:]),
-        bf_end_paren)
+    def writes(self):
+        return [getattr(self, field) for field in self.written_fields]
 
+    def marker(self, *body):
+        fields = [(field, getattr(self, field)) for field in self._fields if field != 'coord']
+        return Marker(name, fields, self.coord, list(body))
 
-def commandtuple(name, fields):
-    def _format_bf(self, *bf):
-        return format_bf(name, self, *bf)
+    def to_bf(self, declaration_mapper, stack_index):
+        return render([self.to_ir(declaration_mapper, stack_index)])
 
     t = namedtuple(name, fields)
-    t.format_bf = _format_bf
+    t.marker = marker
+    t.to_bf = to_bf
+    t.read_fields = []
+    t.consumed_fields = []
+    t.transferred_fields = []
+    t.written_fields = []
+    t.scratch_size = 0
+    t.reads = property(reads)
+    t.consumes = property(consumes)
+    t.writes = property(writes)
     return t
 
 
 class Move(commandtuple('Move', ['coord', 'from_name', 'to_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    consumed_fields = ['from_name']
+    written_fields = ['to_name']
+
+    def to_ir(self, declaration_mapper, stack_index):
         from_pos = declaration_mapper[self.from_name].position
         to_pos = declaration_mapper[self.to_name].position
 
-        return self.format_bf('{}>[-{}+{}]{}<',
-            from_pos,
-            bf_travel(from_pos, to_pos),
-            bf_travel(to_pos, from_pos),
-            from_pos)
+        return self.marker(*at(from_pos, Loop([
+            Change(-1),
+            travel(from_pos, to_pos),
+            Change(1),
+            travel(to_pos, from_pos)])))
 
 
 class Copy(commandtuple('Copy', ['coord', 'from_name', 'to_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    read_fields = ['from_name']
+    written_fields = ['to_name']
+    scratch_size = 1
+
+    def to_ir(self, declaration_mapper, stack_index):
         start_pos = declaration_mapper[self.from_name].position
         end_pos = declaration_mapper[self.to_name].position
 
         staging_pos = stack_index
         move_command = Move(coord=self.coord, from_name=staging_pos, to_name=self.from_name)
 
-        return self.format_bf('{}>[-{}+{}+{}]{}<{}',
-            start_pos,
-            bf_travel(start_pos, staging_pos),
-            bf_travel(staging_pos, end_pos),
-            bf_travel(end_pos, start_pos),
-            start_pos,
-            move_command.to_bf(declaration_mapper, stack_index + 1))
+        return self.marker(
+            *at(start_pos, Loop([
+                Change(-1),
+                travel(start_pos, staging_pos),
+                Change(1),
+                travel(staging_pos, end_pos),
+                Change(1),
+                travel(end_pos, start_pos)])),
+            move_command.to_ir(declaration_mapper, stack_index + 1))
+
+
+def transfer(coord, from_name, to_name):
+    # adds an operand to another cell, emptying it if it's a temp and leaving it as it was if it's
+    # a variable
+    if is_temp(from_name):
+        return Move(coord=coord, from_name=from_name, to_name=to_name)
+    else:
+        return Copy(coord=coord, from_name=from_name, to_name=to_name)
+
+
+def constant_value(value, type):
+    if type in ('int', 'string'):
+        return int(value)
+    elif type == 'char':
+        return ord(value[1])
+    else:
+        raise Exception('Unknown type %s' % type)
 
 
 class SetValue(commandtuple('SetValue', ['coord', 'name', 'value', 'type'])):
-    def to_bf(self, declaration_mapper, stack_index):
-        pos = declaration_mapper[self.name].position
+    written_fields = ['name']
 
-        if self.type in ('int', 'string'):
-            bf_value = self.value
-        elif self.type == 'char':
-            bf_value = ord(self.value[1])
-        else:
-            raise Exception('Unknown type %s' % self.type)
+    def to_ir(self, declaration_mapper, stack_index):
+        pos = declaration_mapper[self.name].position
 
         # zeroing out value is necessary for comma-separated expression lists to result in the
         # correct value
-        return self.format_bf('{}>[-]{}+{}<', pos, bf_value, pos)
+        return self.marker(*at(pos, clear(), Change(constant_value(self.value, self.type))))
 
 
 class SetArrayValues(commandtuple('SetArrayValues', ['coord', 'name', 'values', 'type'])):
-    def to_bf(self, declaration_mapper, stack_index):
-        pos = declaration_mapper[self.name].position
-        bf = '!{}>'.format(pos)
+    written_fields = ['name']
 
-        for i, value in enumerate(self.values):
-            if self.type in ('int', 'string'):
-                bf_value = value
-            elif self.type == 'char':
-                bf_value = ord(value[1])
-            else:
-                raise Exception('Unknown type %s' % self.type)
+    def to_ir(self, declaration_mapper, stack_index):
+        pos = declaration_mapper[self.name].position
+        body = [Breakpoint(), Shift(pos)]
 
+        for value in self.values:
             # zeroing out value is necessary for comma-separated expression lists to result in the
             # correct value
-            bf += '[-]{}+3>'.format(bf_value)
+            body += [clear(), Change(constant_value(value, self.type)), Shift(3)]
 
-        bf += '{}<'.format(pos + 3 * len(self.values))
-        return self.format_bf(bf)
+        body.append(Shift(-(pos + 3 * len(self.values))))
+        return self.marker(*body)
 
 
 class AddressOf(commandtuple('SetValue', ['coord', 'result_name', 'expr'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    written_fields = ['result_name']
+
+    def to_ir(self, declaration_mapper, stack_index):
         expr_type = self.expr.__class__.__name__
         if expr_type != 'ID':
             raise Exception('Unimplemented lvalue type {} for AddressOf operator'.format(expr_type))
 
         lvalue_pos = addressable_offset(declaration_mapper, self.expr.name)
         result_pos = declaration_mapper[self.result_name].position
-        return self.format_bf('{}>[-]{}+{}<', result_pos, lvalue_pos, result_pos)
+        return self.marker(*at(result_pos, clear(), Change(lvalue_pos)))
 
 
 class Zero(commandtuple('Zero', ['coord', 'name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    written_fields = ['name']
+
+    def to_ir(self, declaration_mapper, stack_index):
         pos = declaration_mapper[self.name].position
-        return self.format_bf('{}>[-]{}<', pos, pos)
+        return self.marker(*at(pos, clear()))
+
+
+class Increment(commandtuple('Increment', ['coord', 'name', 'amount'])):
+    written_fields = ['name']
+
+    def to_ir(self, declaration_mapper, stack_index):
+        pos = declaration_mapper[self.name].position
+        return self.marker(*at(pos, Change(self.amount)))
 
 
 class Add(commandtuple('Add', ['coord', 'result_name', 'first_name', 'second_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
-        first_move = Move(coord=self.coord, from_name=self.first_name, to_name=self.result_name)
-        second_move = Move(coord=self.coord, from_name=self.second_name, to_name=self.result_name)
-        return self.format_bf('{}{}',
-            first_move.to_bf(declaration_mapper, stack_index + 1),
-            second_move.to_bf(declaration_mapper, stack_index + 1))
+    transferred_fields = ['first_name', 'second_name']
+    written_fields = ['result_name']
+    scratch_size = 2
+
+    def to_ir(self, declaration_mapper, stack_index):
+        first_move = transfer(self.coord, self.first_name, self.result_name)
+        second_move = transfer(self.coord, self.second_name, self.result_name)
+        return self.marker(
+            first_move.to_ir(declaration_mapper, stack_index + 1),
+            second_move.to_ir(declaration_mapper, stack_index + 1))
 
 
 class Multiply(commandtuple('Multiply', ['coord', 'result_name', 'first_name', 'second_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
-        first_pos = declaration_mapper[self.first_name].position
-        second_pos = declaration_mapper[self.second_name].position
+    read_fields = ['second_name']
+    transferred_fields = ['first_name']
+    written_fields = ['result_name']
+    scratch_size = 3
+
+    def to_ir(self, declaration_mapper, stack_index):
+        setup = []
+        if is_temp(self.first_name):
+            first_pos = declaration_mapper[self.first_name].position
+        else:
+            # a variable is counted down in a copy in the scratch space, so it's left as it was
+            first_pos = stack_index
+            setup.append(Copy(coord=self.coord, from_name=self.first_name, to_name=first_pos)
+                         .to_ir(declaration_mapper, stack_index + 1))
+            stack_index += 1
 
         copy_command = Copy(coord=self.coord, from_name=self.second_name, to_name=self.result_name)
 
-        return self.format_bf('{}>[-{}<{}{}>]{}<', first_pos, first_pos,
-            copy_command.to_bf(declaration_mapper, stack_index + 1), first_pos, first_pos)
+        return self.marker(*setup, *at(first_pos, Loop([
+            Change(-1),
+            Shift(-first_pos),
+            copy_command.to_ir(declaration_mapper, stack_index + 1),
+            Shift(first_pos)])))
+
+
+class MultiplyConstant(commandtuple('MultiplyConstant', ['coord', 'result_name', 'operand_name', 'factor'])):
+    transferred_fields = ['operand_name']
+    written_fields = ['result_name']
+    scratch_size = 1
+
+    def to_ir(self, declaration_mapper, stack_index):
+        operand_pos = declaration_mapper[self.operand_name].position
+        result_pos = declaration_mapper[self.result_name].position
+
+        if is_temp(self.operand_name):
+            return self.marker(*at(operand_pos, Loop([
+                Change(-1),
+                travel(operand_pos, result_pos),
+                Change(self.factor),
+                travel(result_pos, operand_pos)])))
+
+        # like Copy, a variable is staged as it's counted down and moved back afterwards
+        staging_pos = stack_index
+        move_command = Move(coord=self.coord, from_name=staging_pos, to_name=self.operand_name)
+
+        return self.marker(
+            *at(operand_pos, Loop([
+                Change(-1),
+                travel(operand_pos, result_pos),
+                Change(self.factor),
+                travel(result_pos, staging_pos),
+                Change(1),
+                travel(staging_pos, operand_pos)])),
+            move_command.to_ir(declaration_mapper, stack_index + 1))
+
+
+def divmod_base(self, declaration_mapper, stack_index, dividend_name, divisor, quotient):
+    # divisor is either the name of the cell holding it or a constant. The dividend is counted down
+    # once, alongside a countdown of the divisor that is refilled from the remainder each time it
+    # reaches zero, so the remainder and quotient come out of a single loop:
+    #   n 0 1 d 0 0  ->  0 0 1 d-n%d n%d n/d
+    # A zero divisor never counts down to zero, leaving a quotient of 0 and a remainder of n.
+    moves = [transfer(self.coord, dividend_name, stack_index).to_ir(declaration_mapper, stack_index + 6)]
+    if type(divisor) == int:
+        moves += at(stack_index + 3, Change(divisor))
+    else:
+        moves.append(transfer(self.coord, divisor, stack_index + 3).to_ir(declaration_mapper, stack_index + 6))
+
+    result_move = Move(coord=self.coord, from_name=stack_index + (5 if quotient else 4), to_name=self.result_name)
+
+    return self.marker(
+        *moves,
+        travel(0, stack_index),
+        *at(2, Change(1)),
+        Loop([
+            Change(-1), Shift(3), Change(-1), Shift(1), Change(1), Shift(-1),
+            # lands on the flag at 2 if the countdown is zero, and on the empty cell at 1 otherwise
+            Loop([Shift(-1), Change(-1)]), Shift(-1),
+            Loop([Change(-1), Shift(2), Loop([Change(-1), Shift(-1), Change(1), Shift(1)]), Shift(1), Change(1), Shift(-4)]),
+            Shift(1), Change(1), Shift(-2)]),
+        *at(2, clear(), Shift(1), clear(), Shift(-1)),
+        *at(4 if quotient else 5, clear()),
+        travel(stack_index, 0),
+        result_move.to_ir(declaration_mapper, stack_index + 6))
+
+
+class Divide(commandtuple('Divide', ['coord', 'result_name', 'first_name', 'second_name'])):
+    transferred_fields = ['first_name', 'second_name']
+    written_fields = ['result_name']
+    scratch_size = 7
+
+    def to_ir(self, declaration_mapper, stack_index):
+        return divmod_base(self, declaration_mapper, stack_index, self.first_name, self.second_name, True)
+
+
+class Modulo(commandtuple('Modulo', ['coord', 'result_name', 'first_name', 'second_name'])):
+    transferred_fields = ['first_name', 'second_name']
+    written_fields = ['result_name']
+    scratch_size = 7
+
+    def to_ir(self, declaration_mapper, stack_index):
+        return divmod_base(self, declaration_mapper, stack_index, self.first_name, self.second_name, False)
+
 
+class DivideConstant(commandtuple('DivideConstant', ['coord', 'result_name', 'operand_name', 'divisor'])):
+    transferred_fields = ['operand_name']
+    written_fields = ['result_name']
+    scratch_size = 7
 
-def greater_base(self, declaration_mapper, stack_index, greater_than, or_equal):
-    first_move = Move(coord=self.coord, from_name=self.first_name if greater_than else self.second_name, to_name=stack_index + 4)
-    second_move = Move(coord=self.coord, from_name=self.second_name if greater_than else self.first_name, to_name=stack_index + 5)
+    def to_ir(self, declaration_mapper, stack_index):
+        return divmod_base(self, declaration_mapper, stack_index, self.operand_name, self.divisor, True)
+
+
+class ModuloConstant(commandtuple('ModuloConstant', ['coord', 'result_name', 'operand_name', 'divisor'])):
+    transferred_fields = ['operand_name']
+    written_fields = ['result_name']
+    scratch_size = 7
+
+    def to_ir(self, declaration_mapper, stack_index):
+        return divmod_base(self, declaration_mapper, stack_index, self.operand_name, self.divisor, False)
+
+
+def greater_base(self, declaration_mapper, stack_index, greater_than, or_equal, on_true=None):
+    # on_true(pos), if given, is run from the tape position pos instead of setting the result when
+    # the comparison holds
+    first_move = transfer(self.coord, self.first_name if greater_than else self.second_name, stack_index + 4)
+    second_move = transfer(self.coord, self.second_name if greater_than else self.first_name, stack_index + 5)
     result_pos = declaration_mapper[self.result_name].position
 
+    if on_true is None:
+        when_true = [travel(stack_index + 2, result_pos), Change(1), travel(result_pos, stack_index + 2)]
+    else:
+        when_true = on_true(TapeIndices.START_STACK + stack_index + 2)
+
     # from https://stackoverflow.com/a/13327857
-    return self.format_bf('{}{} {} !>>+>> {}>+< [->-[>]<<] <[-{}+{}] <[-<]< {}',
-        first_move.to_bf(declaration_mapper, stack_index + 6),
-        second_move.to_bf(declaration_mapper, stack_index + 6),
-        bf_travel(0, stack_index),
-        '+' if or_equal else '',
-        bf_travel(stack_index + 2, result_pos),
-        bf_travel(result_pos, stack_index + 2),
-        bf_travel(stack_index, 0),
-    )
+    return self.marker(
+        first_move.to_ir(declaration_mapper, stack_index + 6),
+        second_move.to_ir(declaration_mapper, stack_index + 6),
+        travel(0, stack_index),
+        Breakpoint(), Shift(2), Change(1), Shift(2), Change(1 if or_equal else 0),
+        Shift(1), Change(1), Shift(-1),
+        Loop([Change(-1), Shift(1), Change(-1), Loop([Shift(1)]), Shift(-2)]),
+        Shift(-1),
+        Loop([Change(-1)] + when_true),
+        Shift(-1),
+        Loop([Change(-1), Shift(-1)]),
+        Shift(-1),
+        # whatever is left of the larger operand would throw off the next comparison
+        *at(4, clear(), Shift(1), clear(), Shift(-1)),
+        travel(stack_index, 0))
 
 
 class GreaterOrEqual(commandtuple('GreaterOrEqual', ['coord', 'result_name', 'first_name', 'second_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    transferred_fields = ['first_name', 'second_name']
+    written_fields = ['result_name']
+    scratch_size = 7
+
+    def to_ir(self, declaration_mapper, stack_index):
         return greater_base(self, declaration_mapper, stack_index, True, True)
 
+    def to_branch_ir(self, declaration_mapper, stack_index, on_true):
+        return greater_base(self, declaration_mapper, stack_index, True, True, on_true)
+
 
 class Greater(commandtuple('Greater', ['coord', 'result_name', 'first_name', 'second_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    transferred_fields = ['first_name', 'second_name']
+    written_fields = ['result_name']
+    scratch_size = 7
+
+    def to_ir(self, declaration_mapper, stack_index):
         return greater_base(self, declaration_mapper, stack_index, True, False)
 
+    def to_branch_ir(self, declaration_mapper, stack_index, on_true):
+        return greater_base(self, declaration_mapper, stack_index, True, False, on_true)
+
 
 class LesserOrEqual(commandtuple('LesserOrEqual', ['coord', 'result_name', 'first_name', 'second_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    transferred_fields = ['first_name', 'second_name']
+    written_fields = ['result_name']
+    scratch_size = 7
+
+    def to_ir(self, declaration_mapper, stack_index):
         return greater_base(self, declaration_mapper, stack_index, False, True)
 
+    def to_branch_ir(self, declaration_mapper, stack_index, on_true):
+        return greater_base(self, declaration_mapper, stack_index, False, True, on_true)
+
 
 class Lesser(commandtuple('Lesser', ['coord', 'result_name', 'first_name', 'second_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    transferred_fields = ['first_name', 'second_name']
+    written_fields = ['result_name']
+    scratch_size = 7
+
+    def to_ir(self, declaration_mapper, stack_index):
         return greater_base(self, declaration_mapper, stack_index, False, False)
 
+    def to_branch_ir(self, declaration_mapper, stack_index, on_true):
+        return greater_base(self, declaration_mapper, stack_index, False, False, on_true)
+
 
 class Print(commandtuple('Print', ['coord', 'output_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    read_fields = ['output_name']
+
+    def to_ir(self, declaration_mapper, stack_index):
         pos = declaration_mapper[self.output_name].position
-        return self.format_bf('{}>.{}<', pos, pos)
+        return self.marker(*at(pos, Write()))
 
 
 class ForwardMem(commandtuple('ForwardMem', ['coord'])):
-    def to_bf(self, declaration_mapper, stack_index):
-        return '[[-3>+3<]3>-] 2>'
+    def to_ir(self, declaration_mapper, stack_index):
+        return self.marker(
+            Loop([Loop([Change(-1), Shift(3), Change(1), Shift(-3)]), Shift(3), Change(-1)]),
+            Shift(2))
 
 
 class BackMem(commandtuple('BackMem', ['coord'])):
-    def to_bf(self, declaration_mapper, stack_index):
-        return '<[3<]< {}'.format(
-            bf_travel(TapeIndices.START_ADDRESSABLE_MEMORY, TapeIndices.START_STACK)
-        )
+    def to_ir(self, declaration_mapper, stack_index):
+        return self.marker(
+            Shift(-1), Loop([Shift(-3)]), Shift(-1),
+            travel(TapeIndices.START_ADDRESSABLE_MEMORY, TapeIndices.START_STACK))
 
 
 class GoMem(commandtuple('GoMem', ['coord', 'base_name', 'offset_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    read_fields = ['offset_name']
+    scratch_size = 3
+
+    def to_ir(self, declaration_mapper, stack_index):
         base_pos = addressable_offset(declaration_mapper, self.base_name)
         start_addressable_memory_distance = TapeIndices.START_ADDRESSABLE_MEMORY - TapeIndices.START_STACK
         copy_offset_command = Copy(coord=self.coord, from_name=self.offset_name, to_name=start_addressable_memory_distance)
 
-        return self.format_bf('{}{}+{}{}{} {}',
-            bf_travel(TapeIndices.START_STACK, TapeIndices.START_ADDRESSABLE_MEMORY),
-            base_pos,
-            bf_travel(TapeIndices.START_ADDRESSABLE_MEMORY, TapeIndices.START_STACK),
-            copy_offset_command.to_bf(declaration_mapper, stack_index + 2),
-            bf_travel(TapeIndices.START_STACK, TapeIndices.START_ADDRESSABLE_MEMORY),
-            ForwardMem(coord=self.coord).to_bf(declaration_mapper, stack_index + 3))
+        return self.marker(
+            travel(TapeIndices.START_STACK, TapeIndices.START_ADDRESSABLE_MEMORY),
+            Change(base_pos),
+            travel(TapeIndices.START_ADDRESSABLE_MEMORY, TapeIndices.START_STACK),
+            copy_offset_command.to_ir(declaration_mapper, stack_index + 2),
+            travel(TapeIndices.START_STACK, TapeIndices.START_ADDRESSABLE_MEMORY),
+            ForwardMem(coord=self.coord).to_ir(declaration_mapper, stack_index + 3))
 
 
 class PrintString(commandtuple('PrintString', ['coord', 'output_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    read_fields = ['output_name']
+    scratch_size = 2
+
+    def to_ir(self, declaration_mapper, stack_index):
         start_addressable_memory_distance = TapeIndices.START_ADDRESSABLE_MEMORY - TapeIndices.START_STACK
         copy_command = Copy(coord=self.coord, from_name=self.output_name, to_name=start_addressable_memory_distance)
         back_mem_command = BackMem(coord=self.coord)
 
-        return self.format_bf('!{}{} {} [.3>] {}',
-            copy_command.to_bf(declaration_mapper, stack_index + 1),
-            bf_travel(TapeIndices.START_STACK, TapeIndices.START_ADDRESSABLE_MEMORY),
-            ForwardMem(coord=self.coord).to_bf(declaration_mapper, stack_index + 3),
-            back_mem_command.to_bf(declaration_mapper, stack_index + 1))
+        return self.marker(
+            Breakpoint(),
+            copy_command.to_ir(declaration_mapper, stack_index + 1),
+            travel(TapeIndices.START_STACK, TapeIndices.START_ADDRESSABLE_MEMORY),
+            ForwardMem(coord=self.coord).to_ir(declaration_mapper, stack_index + 3),
+            Loop([Write(), Shift(3)]),
+            back_mem_command.to_ir(declaration_mapper, stack_index + 1))
 
 
 class SetAddressableValue(commandtuple('SetAddressableValue', ['coord', 'base_name', 'offset_name', 'rvalue_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    read_fields = ['offset_name']
+    consumed_fields = ['rvalue_name']
+    scratch_size = 4
+
+    def to_ir(self, declaration_mapper, stack_index):
         rvalue_pos = declaration_mapper[self.rvalue_name].position + TapeIndices.START_STACK
         go_mem_command = GoMem(coord=self.coord, base_name=self.base_name, offset_name=self.offset_name)
 
-        return self.format_bf('{}[-{}{} + <[3<]< {}] {}',
-            bf_travel(TapeIndices.START_STACK, rvalue_pos),
-            bf_travel(rvalue_pos, TapeIndices.START_STACK),
-            go_mem_command.to_bf(declaration_mapper, stack_index + 1),
-            bf_travel(TapeIndices.START_ADDRESSABLE_MEMORY, rvalue_pos),
-            bf_travel(rvalue_pos, TapeIndices.START_STACK))
+        return self.marker(
+            # the element is cleared first, so the value replaces it rather than adding to it
+            go_mem_command.to_ir(declaration_mapper, stack_index + 1),
+            clear(),
+            Shift(-1), Loop([Shift(-3)]), Shift(-1),
+            travel(TapeIndices.START_ADDRESSABLE_MEMORY, rvalue_pos),
+            Loop([
+                Change(-1),
+                travel(rvalue_pos, TapeIndices.START_STACK),
+                go_mem_command.to_ir(declaration_mapper, stack_index + 1),
+                Change(1),
+                Shift(-1), Loop([Shift(-3)]), Shift(-1),
+                travel(TapeIndices.START_ADDRESSABLE_MEMORY, rvalue_pos)]),
+            travel(rvalue_pos, TapeIndices.START_STACK))
 
 
 class GetAddressableValue(commandtuple('GetAddressableValue', ['coord', 'base_name', 'offset_name', 'result_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    read_fields = ['offset_name']
+    written_fields = ['result_name']
+    scratch_size = 7
+
+    def to_ir(self, declaration_mapper, stack_index):
         staging_pos = stack_index
         result_pos = declaration_mapper[self.result_name].position
         go_mem_command = GoMem(coord=self.coord, base_name=self.base_name, offset_name=self.offset_name)
@@ -268,20 +476,86 @@ class GetAddressableValue(commandtuple('GetAddressableValue', ['coord', 'base_na
         set_value_command = SetAddressableValue(coord=self.coord, base_name=self.base_name,
                                                 offset_name=self.offset_name, rvalue_name=staging_pos)
 
-        return self.format_bf('!{} ![- <[3<]< {}+ {}+ {}{}] !{} {}',
-            go_mem_command.to_bf(declaration_mapper, stack_index + 2),
-            bf_travel(TapeIndices.START_ADDRESSABLE_MEMORY - TapeIndices.START_STACK, staging_pos),
-            bf_travel(staging_pos, result_pos),
-            bf_travel(result_pos, 0),
-            go_mem_command.to_bf(declaration_mapper, stack_index + 3),
-            back_mem_command.to_bf(declaration_mapper, stack_index + 3),
-            set_value_command.to_bf(declaration_mapper, stack_index + 3))
+        return self.marker(
+            Breakpoint(),
+            go_mem_command.to_ir(declaration_mapper, stack_index + 2),
+            Breakpoint(),
+            Loop([
+                Change(-1),
+                Shift(-1), Loop([Shift(-3)]), Shift(-1),
+                travel(TapeIndices.START_ADDRESSABLE_MEMORY - TapeIndices.START_STACK, staging_pos),
+                Change(1),
+                travel(staging_pos, result_pos),
+                Change(1),
+                travel(result_pos, 0),
+                go_mem_command.to_ir(declaration_mapper, stack_index + 3)]),
+            Breakpoint(),
+            back_mem_command.to_ir(declaration_mapper, stack_index + 3),
+            set_value_command.to_ir(declaration_mapper, stack_index + 3))
 
 
 class Input(commandtuple('Input', ['coord', 'input_name'])):
-    def to_bf(self, declaration_mapper, stack_index):
+    written_fields = ['input_name']
+
+    def to_ir(self, declaration_mapper, stack_index):
         pos = declaration_mapper[self.input_name].position
-        return self.format_bf('{} {}>,{}<', pos, pos)
+        return self.marker(*at(pos, Read()))
+
+
+def unique(names):
+    return list(OrderedDict.fromkeys(names))
+
+
+class WhileLoop(commandtuple('WhileLoop', ['coord', 'cond_name', 'cond_ops', 'body_ops', 'test_first'])):
+    # runs body_ops for as long as cond_name is nonzero, recomputing it with cond_ops at the bottom
+    # of each pass. A temp condition is cleared as it's tested, and a variable one is tested where it
+    # is. Unless test_first is set, the loop is entered with the condition set to 1, as a do-while.
+    # The commands inside leave every temp they use zeroed, so the loop only reads and writes
+    # variables, and consumes temps.
+    def names(self, kinds):
+        names = [self.cond_name]
+        for op in self.cond_ops + self.body_ops:
+            for kind in kinds:
+                names += getattr(op, kind)
+            if type(op) == SetAddressableValue:
+                names.append(op.base_name)
+        return names
+
+    @property
+    def reads(self):
+        return unique(name for name in self.names(['reads', 'consumes']) if not is_temp(name))
+
+    @property
+    def consumes(self):
+        return unique(name for name in self.names(['reads', 'consumes', 'writes']) if is_temp(name))
+
+    @property
+    def writes(self):
+        return unique(name for name in self.names(['consumes', 'writes'])[1:] if not is_temp(name))
+
+    @property
+    def scratch_size(self):
+        return max([op.scratch_size for op in self.cond_ops + self.body_ops], default=0)
+
+    def marker(self, *body):
+        # the commands inside have markers of their own
+        return Marker('WhileLoop', [('cond_name', self.cond_name)], self.coord, list(body))
+
+    def to_ir(self, declaration_mapper, stack_index):
+        cond_pos = declaration_mapper[self.cond_name].position
+
+        def cond_ir():
+            return [op.to_ir(declaration_mapper, stack_index) for op in self.cond_ops]
+
+        start = cond_ir() if self.test_first else at(cond_pos, Change(1))
+        body = [op.to_ir(declaration_mapper, stack_index) for op in self.body_ops]
+        test = [clear()] if is_temp(self.cond_name) else []
+
+        return self.marker(
+            *start,
+            travel(0, cond_pos),
+            Loop(test + [travel(cond_pos, 0)] + body + cond_ir() + [travel(0, cond_pos)]),
+            travel(cond_pos, 0))
 
 
 class EndProgram(commandtuple('EndProgram', [])):
@@ -289,7 +563,8 @@ class EndProgram(commandtuple('EndProgram', [])):
     def coord(self):
         return None
 
-    def to_bf(self, declaration_mapper, stack_index):
-        return self.format_bf('{}-{}',
-            bf_travel(TapeIndices.START_STACK, TapeIndices.STOP_INDICATOR_INDEX),
-            bf_travel(TapeIndices.STOP_INDICATOR_INDEX, TapeIndices.START_STACK))
+    def to_ir(self, declaration_mapper, stack_index):
+        return self.marker(
+            travel(TapeIndices.START_STACK, TapeIndices.STOP_INDICATOR_INDEX),
+            Change(-1),
+            travel(TapeIndices.STOP_INDICATOR_INDEX, TapeIndices.START_STACK))
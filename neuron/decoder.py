@@ -0,0 +1,188 @@
+from collections import namedtuple
+
+
+BF_OPS = '+-><.,[]'
+
+
+# offset addresses the cell an instruction works on relative to the pointer, and args carries the
+# operands of the instructions the loader synthesizes from whole loops, which don't correspond to a
+# single BF op
+class Instruction(namedtuple('Instruction', ['op', 'count', 'start', 'index', 'offset', 'args'],
+                             defaults=[0, None])):
+    pass
+
+
+def decode(code):
+    # strips color codes, {...} comments and formatting from the code, leaving only the executable
+    # ops, each with its run-length count and the range of source it was decoded from (start is
+    # where the op's count begins, index is the op character itself)
+    instructions = []
+    number = None
+    start = 0
+    comment = False
+    color_code = False
+
+    for index, c in enumerate(code):
+        if c == '{':
+            comment = True
+        elif c == '}':
+            comment = False
+        elif c == '\033':
+            color_code = True
+        elif color_code and c == 'm':
+            color_code = False
+        elif not comment and not color_code:
+            if c in BF_OPS:
+                instructions.append(Instruction(op=c, count=1 if number is None else number,
+                                                start=start, index=index))
+                number = None
+                start = index + 1
+
+            elif '0' <= c <= '9':
+                digit = ord(c) - ord('0')
+                number = digit if number is None else number*10 + digit
+
+            elif c == '!':
+                instructions.append(Instruction(op=c, count=1, start=start, index=index))
+                start = index + 1
+
+            else:
+                start = index + 1
+
+    return instructions
+
+
+def match_brackets(instructions):
+    # maps the position of every bracket in the instruction stream to the position of its match,
+    # so jumps don't have to scan the code
+    jumps = [None] * len(instructions)
+    open_pcs = []
+
+    for pc, instruction in enumerate(instructions):
+        if instruction.op == '[':
+            open_pcs.append(pc)
+        elif instruction.op == ']':
+            if len(open_pcs) == 0:
+                raise Exception('Unmatched "]" at index {}'.format(instruction.index))
+
+            open_pc = open_pcs.pop()
+            jumps[open_pc] = pc
+            jumps[pc] = open_pc
+
+    if len(open_pcs) > 0:
+        raise Exception('Unmatched "[" at indices {}'.format(
+            ', '.join(str(instructions[pc].index) for pc in open_pcs)))
+
+    return jumps
+
+
+def loop_idiom(loop_start, body, loop_end):
+    # recognizes a loop made only of pointer moves and cell changes, which is how the compiler
+    # clears (Zero, SetValue), transfers (Move, Copy, Multiply) and scans (BackMem, IPCheck)
+    if any(i.op not in '+-<>' for i in body):
+        return None
+
+    offset = 0
+    deltas = {}
+    for i in body:
+        if i.op == '>':
+            offset += i.count
+        elif i.op == '<':
+            offset -= i.count
+        elif i.op == '+':
+            deltas[offset] = deltas.get(offset, 0) + i.count
+        else:
+            deltas[offset] = deltas.get(offset, 0) - i.count
+
+    deltas = {o: d for o, d in deltas.items() if d != 0}
+
+    if offset != 0:
+        if len(deltas) > 0:
+            return None
+
+        return Instruction(op='scan', count=offset, start=loop_start.start, index=loop_end.index)
+
+    # only a loop that decrements its own cell by one runs a number of times known up front
+    if deltas.get(0) != -1:
+        return None
+
+    targets = tuple(sorted((o, d) for o, d in deltas.items() if o != 0))
+    if len(targets) == 0:
+        return Instruction(op='clear', count=1, start=loop_start.start, index=loop_end.index)
+
+    return Instruction(op='transfer', count=1, start=loop_start.start, index=loop_end.index, args=targets)
+
+
+def fold_loops(instructions):
+    # replaces innermost loops the compiler emits as idioms with single instructions, so that e.g.
+    # a Move costs one step no matter how large the moved value is
+    jumps = match_brackets(instructions)
+    folded = []
+    pc = 0
+
+    while pc < len(instructions):
+        instruction = instructions[pc]
+
+        if instruction.op == '[':
+            end_pc = jumps[pc]
+            idiom = loop_idiom(instruction, instructions[pc+1:end_pc], instructions[end_pc])
+            if idiom is not None:
+                folded.append(idiom)
+                pc = end_pc + 1
+                continue
+
+        folded.append(instruction)
+        pc += 1
+
+    return folded
+
+
+def fuse_offsets(instructions):
+    # turns each straight-line run of pointer moves and cell changes (e.g. a travel there, some
+    # +'s and a travel back) into '+' instructions at offsets from the pointer, followed by a
+    # single '>' for the run's net movement if there is any. Other instructions that only touch the
+    # cell under the pointer are addressed by offset too, rather than ending the run.
+    fused = []
+    deltas = {}
+    offset = 0
+    run = []
+
+    def flush_deltas():
+        for delta_offset, delta in deltas.items():
+            if delta != 0:
+                fused.append(Instruction(op='+', count=delta, start=run[0].start, index=run[-1].index,
+                                         offset=delta_offset))
+        deltas.clear()
+
+    def end_run():
+        nonlocal offset
+        flush_deltas()
+        if offset != 0:
+            fused.append(Instruction(op='>', count=offset, start=run[0].start, index=run[-1].index))
+
+        offset = 0
+        run.clear()
+
+    for instruction in instructions:
+        op = instruction.op
+        if op in ('+', '-', '>', '<'):
+            run.append(instruction)
+            if op == '>':
+                offset += instruction.count
+            elif op == '<':
+                offset -= instruction.count
+            else:
+                delta = instruction.count if op == '+' else -instruction.count
+                deltas[offset] = deltas.get(offset, 0) + delta
+
+        elif op in ('clear', 'transfer', '.', ','):
+            run.append(instruction)
+            flush_deltas()
+            fused.append(instruction._replace(offset=offset))
+
+        else:
+            end_run()
+            fused.append(instruction)
+
+    end_run()
+    return fused
@@ -0,0 +1,204 @@
+from collections import Counter
+
+from .decoder import fold_loops, fuse_offsets, match_brackets
+
+
+def strip_debug_instructions(instructions, breakpoints=False):
+    # breakpoints and zero-count ops only matter to the debugger, which stops and counts a step on
+    # them. breakpoints keeps the former, for code that hands them back to the debugger.
+    return [i for i in instructions if (i.op != '!' or breakpoints) and (i.count > 0 or i.op in '[]')]
+
+
+def read_input_char():
+    line = ''
+    while len(line) == 0:
+        print('> ', end='')
+        line = input()
+
+    return ord(line[0])
+
+
+def bad_pointer(pointer, instruction):
+    return Exception("Bad tape pointer: {} at index {}".format(pointer, instruction.index))
+
+
+def load(instructions, breakpoints=False):
+    return fuse_offsets(fold_loops(strip_debug_instructions(instructions, breakpoints)))
+
+
+def tape_reach(instructions):
+    # the furthest any instruction reaches to the right of the pointer; the tape is kept at least
+    # this long past the pointer, so offset instructions never have to grow it
+    reach = 0
+    for i in instructions:
+        reach = max(reach, i.offset)
+        if i.op == 'transfer':
+            reach = max([reach] + [i.offset + target for target, factor in i.args])
+
+    return reach
+
+
+def run(instructions, tape, pointer=0, mask=-1):
+    # headless counterpart to BrainfuckRuntime.execute: the same tape, pointer and output semantics,
+    # without any of the debugger's stepping, history or highlighting bookkeeping. Cell values wrap
+    # around by and-ing them with mask.
+    instructions = load(instructions)
+    jumps = match_brackets(instructions)
+    ops = [i.op for i in instructions]
+    counts = [i.count for i in instructions]
+    offsets = [i.offset for i in instructions]
+    args = [i.args for i in instructions]
+
+    reach = tape_reach(instructions)
+    if pointer + reach >= len(tape):
+        tape.extend([0] * (pointer + reach - len(tape) + 1))
+
+    output = []
+    instr_count = 0
+    pc = 0
+    end = len(ops)
+
+    while pc < end:
+        op = ops[pc]
+
+        if op == '+':
+            cell = pointer + offsets[pc]
+            if cell < 0:
+                raise bad_pointer(cell, instructions[pc])
+
+            tape[cell] = (tape[cell] + counts[pc]) & mask
+
+        elif op == '>':
+            pointer += counts[pc]
+            if pointer < 0:
+                raise bad_pointer(pointer, instructions[pc])
+            if pointer + reach >= len(tape):
+                tape.extend([0] * (pointer + reach - len(tape) + 1))
+
+        elif op == '[':
+            if tape[pointer] == 0:
+                pc = jumps[pc]
+
+        elif op == ']':
+            if tape[pointer] != 0:
+                pc = jumps[pc]
+
+        elif op == 'clear':
+            cell = pointer + offsets[pc]
+            if cell < 0:
+                raise bad_pointer(cell, instructions[pc])
+
+            tape[cell] = 0
+
+        elif op == 'transfer':
+            cell = pointer + offsets[pc]
+            if cell < 0:
+                raise bad_pointer(cell, instructions[pc])
+
+            value = tape[cell]
+            if value != 0:
+                for target, factor in args[pc]:
+                    if cell + target < 0:
+                        raise bad_pointer(cell + target, instructions[pc])
+
+                    tape[cell + target] = (tape[cell + target] + value * factor) & mask
+
+                tape[cell] = 0
+
+        elif op == 'scan':
+            step = counts[pc]
+            while tape[pointer] != 0:
+                pointer += step
+                if pointer < 0:
+                    raise bad_pointer(pointer, instructions[pc])
+                if pointer + reach >= len(tape):
+                    tape.extend([0] * (pointer + reach - len(tape) + 1))
+
+        elif op == '.':
+            cell = pointer + offsets[pc]
+            if cell < 0:
+                raise bad_pointer(cell, instructions[pc])
+
+            output.append(chr(tape[cell]) * counts[pc])
+
+        elif op == ',':
+            cell = pointer + offsets[pc]
+            if cell < 0:
+                raise bad_pointer(cell, instructions[pc])
+
+            for i in range(counts[pc]):
+                tape[cell] = read_input_char() & mask
+
+        pc += 1
+        instr_count += 1
+
+    return pointer, ''.join(output), instr_count
+
+
+def profile(instructions, tape, pointer=0, mask=-1):
+    # runs the instructions like run does, but also counts how many of them touch each cell, in a
+    # plainer loop since it isn't meant to be fast. Returns the pointer, output and the counts.
+    instructions = load(instructions)
+    jumps = match_brackets(instructions)
+    reach = tape_reach(instructions)
+    cell_counts = Counter()
+    output = []
+    pc = 0
+
+    def cell_at(offset, touch=True):
+        if pointer + offset < 0:
+            raise bad_pointer(pointer + offset, instructions[pc])
+        if pointer + offset + reach >= len(tape):
+            tape.extend([0] * (pointer + offset + reach - len(tape) + 1))
+
+        if touch:
+            cell_counts[pointer + offset] += 1
+        return pointer + offset
+
+    while pc < len(instructions):
+        instruction = instructions[pc]
+        op = instruction.op
+
+        if op == '+':
+            cell = cell_at(instruction.offset)
+            tape[cell] = (tape[cell] + instruction.count) & mask
+
+        elif op == '>':
+            pointer += instruction.count
+            cell_at(0, touch=False)
+
+        elif op == '[':
+            if tape[cell_at(0)] == 0:
+                pc = jumps[pc]
+
+        elif op == ']':
+            if tape[cell_at(0)] != 0:
+                pc = jumps[pc]
+
+        elif op == 'clear':
+            tape[cell_at(instruction.offset)] = 0
+
+        elif op == 'transfer':
+            cell = cell_at(instruction.offset)
+            value = tape[cell]
+            for target, factor in instruction.args:
+                target_cell = cell_at(instruction.offset + target)
+                tape[target_cell] = (tape[target_cell] + value * factor) & mask
+            tape[cell] = 0
+
+        elif op == 'scan':
+            while tape[cell_at(0)] != 0:
+                pointer += instruction.count
+                cell_at(0, touch=False)
+
+        elif op == '.':
+            output.append(chr(tape[cell_at(instruction.offset)]) * instruction.count)
+
+        elif op == ',':
+            cell = cell_at(instruction.offset)
+            for i in range(instruction.count):
+                tape[cell] = read_input_char() & mask
+
+        pc += 1
+
+    return pointer, ''.join(output), cell_counts
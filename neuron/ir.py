@@ -0,0 +1,109 @@
+from collections import namedtuple
+
+from .console import colored_text, TextColor
+
+
+# commands lower into these nodes rather than into text, so passes over the generated code can work
+# on its structure; text is only produced by render, once the whole program has been built
+Shift = namedtuple('Shift', ['count'])
+Change = namedtuple('Change', ['count'])
+Loop = namedtuple('Loop', ['body'])
+Write = namedtuple('Write', [])
+Read = namedtuple('Read', [])
+Breakpoint = namedtuple('Breakpoint', [])
+
+# groups the nodes of a command, or of a piece of the block dispatcher, under its name; renders as
+# (Name {field=value, ...} body), which the debugger and run.py's pretty-printer use for structure
+Marker = namedtuple('Marker', ['name', 'fields', 'coord', 'body'])
+
+
+def section(name, *body):
+    return Marker(name, [], None, list(body))
+
+
+def travel(from_pos, to_pos):
+    return Shift(to_pos - from_pos)
+
+
+def clear():
+    return Loop([Change(-1)])
+
+
+def at(pos, *body):
+    # runs body at pos and comes back
+    return [Shift(pos)] + list(body) + [Shift(-pos)]
+
+
+def render_count(count, up, down):
+    if count == 0:
+        return ''
+    symbol = up if count > 0 else down
+    return symbol if abs(count) == 1 else '{}{}'.format(abs(count), symbol)
+
+
+class Renderer:
+    def __init__(self, color=True, symbol_table=None):
+        self.color = color
+        self.symbol_table = symbol_table
+        self.output = []
+        self.length = 0
+
+    def colored(self, color, text):
+        return colored_text(color, text) if self.color else text
+
+    def append(self, text):
+        self.output.append(text)
+        self.length += len(text)
+
+    def render_marker(self, marker):
+        start = self.length
+
+        fields = ['{}{}{}'.format(self.colored(TextColor.LIGHT_GRAY, name),
+                                  self.colored(TextColor.LIGHT_GRAY, '='),
+                                  self.colored(TextColor.LIGHT_YELLOW, value))
+                  for name, value in marker.fields]
+
+        formatted_fields = ''
+        if len(fields) > 0:
+            formatted_fields = ' {}{}{}'.format(
+                self.colored(TextColor.LIGHT_GRAY, '{'),
+                ', '.join(fields),
+                self.colored(TextColor.LIGHT_GRAY, '}'))
+
+        self.append('{}{}{} '.format(
+            self.colored(TextColor.LIGHT_GRAY, '('),
+            self.colored(TextColor.LIGHT_GREEN, marker.name),
+            formatted_fields))
+        self.render(marker.body)
+        self.append(self.colored(TextColor.LIGHT_GRAY, ')'))
+
+        if self.symbol_table is not None and marker.coord is not None:
+            self.symbol_table[(start, self.length)] = marker.coord
+
+    def render(self, nodes):
+        for node in nodes:
+            if isinstance(node, Shift):
+                self.append(render_count(node.count, '>', '<'))
+            elif isinstance(node, Change):
+                self.append(render_count(node.count, '+', '-'))
+            elif isinstance(node, Loop):
+                self.append('[')
+                self.render(node.body)
+                self.append(']')
+            elif isinstance(node, Write):
+                self.append('.')
+            elif isinstance(node, Read):
+                self.append(',')
+            elif isinstance(node, Breakpoint):
+                self.append('!')
+            elif isinstance(node, Marker):
+                self.render_marker(node)
+            else:
+                raise Exception('Unknown IR node {}'.format(node))
+
+
+def render(nodes, color=True, symbol_table=None):
+    # if a symbol table is given, the range of text each marker with a coord renders to is added to it
+    renderer = Renderer(color, symbol_table)
+    renderer.render(nodes)
+    return ''.join(renderer.output)
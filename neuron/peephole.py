@@ -0,0 +1,208 @@
+from collections import Counter
+
+from .ir import Breakpoint, Change, Loop, Marker, Read, Shift, Write
+
+
+class Token:
+    # a block's IR flattened into a list, so runs can be merged across markers. Loops and markers
+    # become an opening and a closing token around their bodies.
+    def __init__(self, kind, value, owner):
+        self.kind = kind
+        self.value = value
+        self.owner = owner
+
+    @property
+    def is_op(self):
+        return self.kind in ('move', 'add', '[', ']', '.', ',', '!')
+
+    def remove(self):
+        self.kind = 'removed'
+
+
+def flatten(nodes, owner, tokens):
+    for node in nodes:
+        if isinstance(node, Shift):
+            tokens.append(Token('move', node.count, owner))
+        elif isinstance(node, Change):
+            tokens.append(Token('add', node.count, owner))
+        elif isinstance(node, Loop):
+            tokens.append(Token('[', None, owner))
+            flatten(node.body, owner, tokens)
+            tokens.append(Token(']', None, owner))
+        elif isinstance(node, Write):
+            tokens.append(Token('.', None, owner))
+        elif isinstance(node, Read):
+            tokens.append(Token(',', None, owner))
+        elif isinstance(node, Breakpoint):
+            tokens.append(Token('!', None, owner))
+        elif isinstance(node, Marker):
+            tokens.append(Token('marker', node, owner))
+            flatten(node.body, owner, tokens)
+            tokens.append(Token('end', None, owner))
+        else:
+            raise Exception('Unknown IR node {}'.format(node))
+
+
+def unflatten(tokens):
+    openers = []
+    bodies = [[]]
+    for token in tokens:
+        if token.kind in ('[', 'marker'):
+            openers.append(token)
+            bodies.append([])
+        elif token.kind in (']', 'end'):
+            opener = openers.pop()
+            body = bodies.pop()
+            if opener.kind == '[':
+                bodies[-1].append(Loop(body))
+            else:
+                bodies[-1].append(opener.value._replace(body=body))
+        elif token.kind == 'move':
+            bodies[-1].append(Shift(token.value))
+        elif token.kind == 'add':
+            bodies[-1].append(Change(token.value))
+        elif token.kind == '.':
+            bodies[-1].append(Write())
+        elif token.kind == ',':
+            bodies[-1].append(Read())
+        elif token.kind == '!':
+            bodies[-1].append(Breakpoint())
+    return bodies[0]
+
+
+def merge_runs(tokens, removed):
+    # cancels and combines adjacent moves and adjacent adds, e.g. a command's travel back to the
+    # stack followed by the next command's travel away from it
+    changed = False
+    ops = []
+
+    for token in tokens:
+        if not token.is_op:
+            continue
+
+        if token.kind in ('move', 'add') and token.value == 0:
+            token.remove()
+            changed = True
+            continue
+
+        if len(ops) > 0 and ops[-1].kind == token.kind and token.kind in ('move', 'add'):
+            last = ops[-1]
+            last.value += token.value
+            removed[token.owner] += 1
+            token.remove()
+            changed = True
+
+            if last.value == 0:
+                removed[last.owner] += 1
+                last.remove()
+                ops.pop()
+            continue
+
+        ops.append(token)
+
+    return changed
+
+
+def match_loops(tokens):
+    matches = {}
+    open_indexes = []
+    for index, token in enumerate(tokens):
+        if token.kind == '[':
+            open_indexes.append(index)
+        elif token.kind == ']':
+            matches[open_indexes.pop()] = index
+    return matches
+
+
+def loop_effect(tokens, matches, start, end):
+    # whether the loop from start to end leaves the pointer where it found it, and which cells,
+    # relative to the loop's cell, it can change
+    offset = 0
+    touched = set([0])
+    index = start + 1
+
+    while index < end:
+        token = tokens[index]
+        if token.kind == 'move':
+            offset += token.value
+        elif token.kind in ('add', ','):
+            touched.add(offset)
+        elif token.kind == '[':
+            neutral, inner_touched = loop_effect(tokens, matches, index, matches[index])
+            if not neutral:
+                return False, None
+            touched |= set(offset + t for t in inner_touched)
+            index = matches[index]
+        index += 1
+
+    return offset == 0, touched
+
+
+def remove_dead_loops(tokens, removed):
+    # follows the pointer and the values it knows of through straight-line code, and drops loops
+    # that start on a cell known to be zero, such as a [-] on a cell the previous command cleared
+    changed = False
+    matches = match_loops(tokens)
+    position = 0
+    known = {}
+    index = 0
+
+    while index < len(tokens) and position is not None:
+        token = tokens[index]
+
+        if token.kind == 'move':
+            position += token.value
+
+        elif token.kind == 'add':
+            if position in known:
+                known[position] += token.value
+
+        elif token.kind == ',':
+            known.pop(position, None)
+
+        elif token.kind == '[':
+            end = matches[index]
+            if known.get(position) == 0:
+                # markers inside the loop go with it, so the ones left stay balanced
+                for dead in tokens[index:end+1]:
+                    if dead.is_op:
+                        removed[dead.owner] += 1
+                    dead.remove()
+                changed = True
+
+            else:
+                neutral, touched = loop_effect(tokens, matches, index, end)
+                if neutral:
+                    for offset in touched:
+                        known.pop(position + offset, None)
+                    known[position] = 0
+                else:
+                    position = None
+
+            index = end
+
+        index += 1
+
+    return changed
+
+
+def optimize_block(nodes):
+    # nodes is the body of a block, a marker for each command and pieces of the dispatcher between
+    # them; returns the optimized nodes and a count of the instructions removed from each kind of
+    # command. The ones removed from code outside of any command are counted under 'Block'.
+    tokens = []
+    for owner, node in enumerate(nodes):
+        flatten([node], owner, tokens)
+
+    removed_by_owner = Counter()
+    changed = True
+    while changed:
+        changed = merge_runs(tokens, removed_by_owner)
+        changed = remove_dead_loops(tokens, removed_by_owner) or changed
+
+    removed = Counter()
+    for owner, count in removed_by_owner.items():
+        node = nodes[owner]
+        removed[node.name if isinstance(node, Marker) else 'Block'] += count
+
+    return unflatten(tokens), removed
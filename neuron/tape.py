@@ -0,0 +1,41 @@
+from array import array
+
+from .tape_indices import TapeIndices
+
+
+CELL_BITS = (8, 16, 32)
+
+# room left after the static segment before the tape has to grow
+TAPE_MARGIN = 16
+
+
+def cell_typecode(cell_bits):
+    for typecode in 'BHIL':
+        if array(typecode).itemsize * 8 >= cell_bits:
+            return typecode
+
+
+def cell_mask(cell_bits):
+    # and-ing a value with -1 leaves it unchanged, which lets unbounded cells go through the same
+    # arithmetic as wrapping ones
+    if cell_bits is None:
+        return -1
+    return (1 << cell_bits) - 1
+
+
+def tape_size(static_data):
+    # each character of static data, plus each string's terminator, takes up one 3-cell slot
+    static_data_size = sum([len(data) for data in static_data]) + len(static_data)
+    return TapeIndices.START_STATIC_SEGMENT + 3 * static_data_size + TAPE_MARGIN
+
+
+def new_tape(size, cell_bits=None):
+    # unbounded cells need a list; fixed-width ones are packed into an array, and wrap around on
+    # overflow and underflow
+    if cell_bits is None:
+        return [0] * size
+
+    if cell_bits not in CELL_BITS:
+        raise Exception('Unsupported cell width {}, expected one of {}'.format(cell_bits, CELL_BITS))
+
+    return array(cell_typecode(cell_bits), [0]) * size
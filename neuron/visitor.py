@@ -1,9 +1,12 @@
-from collections import namedtuple, OrderedDict
+from collections import Counter, defaultdict, namedtuple, OrderedDict
+from itertools import combinations, count
 from pycparser import c_parser, c_ast, parse_file
 import sys
 
 from .commands import *
 from .ordered_set import OrderedSet
+from .ir import Breakpoint, Change, Loop, Shift, at, clear, render, section, travel
+from .peephole import optimize_block
 from .tape_indices import TapeIndices
 
 
@@ -13,6 +16,10 @@ class Block:
         self.ops = list(ops)
         self.next_index = None
 
+    def accesses(self):
+        # the names each step of the block reads, consumes and writes, in order
+        return [step for op in self.ops for step in command_accesses(op)]
+
     def pretty_print(self):
         ret = ['Block(index=%s, next=%s):' % (self.index, self.next_index)]
         if len(self.ops) > 0:
@@ -43,6 +50,11 @@ class IfBlock:
         self.false_blocks = false_blocks
         self.decl_name = decl_name
 
+    def accesses(self):
+        # branching on the condition consumes it, unless it's a variable
+        branch = ([], [self.decl_name], []) if is_temp(self.decl_name) else ([self.decl_name], [], [])
+        return [step for op in self.cond_block for step in command_accesses(op)] + [branch]
+
     def pretty_print(self):
         ret = ['IfBlock(index={}, decl_name={}):'.format(self.index, self.decl_name)]
         ret += ['    Cond block:']
@@ -62,6 +74,129 @@ class IfBlock:
         return self.__str__()
 
 
+class LoopBlock(IfBlock):
+    # the test of a loop whose body goes through the dispatcher. The body's last block jumps back
+    # here, so its true branch needs no jump to the block after it. entry_index is where the loop
+    # starts, which is the body rather than the test for a do-while.
+    def __init__(self, index, cond_block, true_blocks, false_blocks, decl_name, entry_index):
+        super().__init__(index, cond_block, true_blocks, false_blocks, decl_name)
+        self.entry_index = entry_index
+
+    def __str__(self):
+        return "LoopBlock(index={}, decl_name={}, true_blocks={}, false_blocks={}, cond_block={})".format(
+            self.index, self.decl_name, self.true_blocks, self.false_blocks, self.cond_block)
+
+
+def command_accesses(op):
+    # the names each step of a command reads, consumes and writes. Zeroing a temp leaves it as
+    # clean as consuming it, without reading it. A loop's steps are its condition's commands, its
+    # test, its body's commands and its condition's again, so the temps used inside it can share
+    # cells with each other.
+    if type(op) == Zero and is_temp(op.name):
+        return [([], [op.name], [op.name])]
+    elif type(op) != WhileLoop:
+        return [(op.reads, op.consumes, op.writes)]
+
+    test = ([], [op.cond_name], []) if is_temp(op.cond_name) else ([op.cond_name], [], [])
+    cond = [step for cond_op in op.cond_ops for step in command_accesses(cond_op)]
+    body = [step for body_op in op.body_ops for step in command_accesses(body_op)]
+    start = cond if op.test_first else [([], [], [op.cond_name])]
+    return start + [test] + body + cond + [test]
+
+
+def clean_temps(coord, ops, kept=None):
+    # zeros the temps commands leave holding a value, other than kept, so they're clean the next
+    # time the commands run
+    dirty = sorted(live_ranges([Block(None, ops)])[1])
+    return ops + [Zero(coord=coord, name=name) for name in dirty if name != kept]
+
+
+# the command each binary operator compiles to, and how to evaluate it when both operands are known
+# at compile time
+def c_divide(a, b):
+    # C division truncates toward zero, where python's floors
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+
+def c_modulo(a, b):
+    return a - b * c_divide(a, b)
+
+
+BINARY_OPS = {
+    '+': (Add, lambda a, b: a + b),
+    '*': (Multiply, lambda a, b: a * b),
+    '/': (Divide, c_divide),
+    '%': (Modulo, c_modulo),
+    '>=': (GreaterOrEqual, lambda a, b: int(a >= b)),
+    '>': (Greater, lambda a, b: int(a > b)),
+    '<=': (LesserOrEqual, lambda a, b: int(a <= b)),
+    '<': (Lesser, lambda a, b: int(a < b)),
+}
+
+
+# the amount each increment and decrement operator adds, and whether it gives the value from before
+INCREMENTS = {
+    '++': (1, False),
+    '--': (-1, False),
+    'p++': (1, True),
+    'p--': (-1, True),
+}
+
+
+def fold_constant(node):
+    # the value of an expression made up only of int and char constants, or None
+    if type(node) == c_ast.Constant and node.type in ('int', 'char'):
+        return constant_value(node.value, node.type)
+
+    elif type(node) == c_ast.BinaryOp and node.op in BINARY_OPS:
+        first = fold_constant(node.left)
+        second = fold_constant(node.right)
+        # a zero divisor is left for visit_BinaryOp to report
+        if first is not None and second is not None and not (node.op in ('/', '%') and second == 0):
+            return BINARY_OPS[node.op][1](first, second)
+
+    return None
+
+
+def value_bound(node):
+    # an upper bound on the value of an expression, if one is known at compile time
+    value = fold_constant(node)
+    if value is not None:
+        return value
+
+    if type(node) == c_ast.BinaryOp:
+        if node.op in ('>=', '>', '<=', '<'):
+            return 1
+
+        first = value_bound(node.left)
+        second = value_bound(node.right)
+        if first is not None and second is not None and node.op in ('+', '*'):
+            return BINARY_OPS[node.op][1](first, second)
+        elif node.op == '/':
+            return first
+        elif node.op == '%' and second is not None:
+            return second - 1
+        elif node.op == '%':
+            return first
+
+    return None
+
+
+def has_side_effects(node):
+    if type(node) in (c_ast.FuncCall, c_ast.Assignment):
+        return True
+    if type(node) == c_ast.UnaryOp and node.op in INCREMENTS:
+        return True
+    return any(has_side_effects(child) for child_name, child in node.children())
+
+
+def references(node, name):
+    if type(node) == c_ast.ID and node.name == name:
+        return True
+    return any(references(child, name) for child_name, child in node.children())
+
+
 def parse_array_ref(array_ref):
     ar = array_ref
     subscripts = []
@@ -92,25 +227,565 @@ class MappedDeclaration(namedtuple('MappedDeclaration', ['declaration', 'positio
     pass
 
 
+class Slot(namedtuple('Slot', ['size', 'shared', 'names'])):
+    pass
+
+
+def live_ranges(blocks):
+    # returns the steps of each block every temp is used in, as a list of first and last steps, and
+    # the temps that are left holding a value at the end of one of those ranges, or that start one
+    # by reading a value left over from another block. A step that consumes and writes a temp at once
+    # clears it. A temp that's written again after it's been consumed starts a new range, so that a
+    # loop's condition temps, which are computed both before it and at the bottom of each pass,
+    # don't keep the cell through the loop's body.
+    ranges = {}
+    dirty = set()
+
+    for block_number, block in enumerate(blocks):
+        last_kinds = {}
+        for step, (reads, consumes, writes) in enumerate(block.accesses()):
+            for kind, names in (('read', reads), ('consume', consumes), ('write', writes)):
+                for name in filter(is_temp, names):
+                    block_ranges = ranges.setdefault(name, {}).setdefault(block_number, [])
+                    if len(block_ranges) > 0 and (last_kinds[name] != 'consume' or block_ranges[-1][1] == step):
+                        block_ranges[-1] = (block_ranges[-1][0], step)
+                    else:
+                        if kind != 'write' and name not in writes:
+                            dirty.add(name)
+                        block_ranges.append((step, step))
+                    last_kinds[name] = 'consume' if name in consumes else kind
+
+        dirty |= set(name for name, kind in last_kinds.items() if kind != 'consume')
+
+    return ranges, dirty
+
+
+def ranges_interfere(first_ranges, second_ranges):
+    for block_number, first_block_ranges in first_ranges.items():
+        for first_start, first_end in first_block_ranges:
+            for second_start, second_end in second_ranges.get(block_number, []):
+                if first_start <= second_end and second_start <= first_end:
+                    return True
+    return False
+
+
+def declaration_use_counts(blocks, profile=None):
+    # how often each declaration is used, and how often each pair of declarations is used by the
+    # same command. The counts come from a profile of a previous run if one is given, in which case
+    # a pair counts as often as the least used of the two; otherwise they're the number of commands
+    # using them.
+    counts = Counter()
+    pair_counts = Counter()
+
+    for block in blocks:
+        for reads, consumes, writes in block.accesses():
+            names = sorted(set(name for name in reads + consumes + writes if type(name) == str))
+            counts.update(names)
+            for first, second in combinations(names, 2):
+                if profile is None:
+                    pair_counts[(first, second)] += 1
+                else:
+                    pair_counts[(first, second)] += min(profile.get(first, 0), profile.get(second, 0))
+
+    if profile is not None:
+        counts = Counter(profile)
+
+    return counts, pair_counts
+
+
+def order_by_use(slots, counts, pair_counts):
+    # puts the most used slot first, and after each slot the remaining one it's used with the most,
+    # or the most used remaining one if it isn't used with any
+    def slot_count(slot):
+        return sum([counts[name] for name in slot.names])
+
+    def pair_count(first, second):
+        return sum([pair_counts[tuple(sorted((a, b)))] for a in first.names for b in second.names])
+
+    remaining = sorted(slots, key=slot_count, reverse=True)
+    ordered = []
+
+    while len(remaining) > 0:
+        slot = remaining[0]
+        if len(ordered) > 0:
+            paired = max(remaining, key=lambda candidate: pair_count(ordered[-1], candidate))
+            if pair_count(ordered[-1], paired) > 0:
+                slot = paired
+
+        ordered.append(slot)
+        remaining.remove(slot)
+
+    return ordered
+
+
+# commands that cost more than copying their result from a cell that already holds it
+COMPARISON_COMMANDS = (GreaterOrEqual, Greater, LesserOrEqual, Lesser)
+
+REUSABLE_COMMANDS = (Multiply, MultiplyConstant, Divide, Modulo, DivideConstant, ModuloConstant,
+                     GreaterOrEqual, Greater, LesserOrEqual, Lesser, GetAddressableValue)
+
+
+def command_key(op, numbers):
+    # what a command computes, in terms of the value numbers of the cells it uses
+    operands = tuple((field, numbers[value] if type(value) == str else value)
+                     for field, value in zip(op._fields, op)
+                     if field != 'coord' and field not in op.written_fields)
+    if type(op) == Multiply:
+        operands = tuple(sorted(number for field, number in operands))
+    return (type(op).__name__,) + operands
+
+
+def eliminate_common_subexpressions(ops):
+    # numbers the value in each cell, giving a cell a new number whenever a command changes it. A
+    # reusable command that computes the same thing from the same numbers as an earlier one is
+    # replaced with a copy of the earlier result, or of a copy of it, from a cell that hasn't
+    # changed since. Array elements are numbered along with their array, so writing to one through
+    # SetAddressableValue changes the number of the whole array.
+    new_number = count().__next__
+    numbers = defaultdict(new_number)
+    values = {}
+    holders = defaultdict(list)
+    result = []
+
+    for op in ops:
+        # a loop's commands run more than once, so they're only compared with each other
+        if type(op) == WhileLoop:
+            op = op._replace(cond_ops=eliminate_common_subexpressions(op.cond_ops),
+                             body_ops=eliminate_common_subexpressions(op.body_ops))
+
+        key = None
+        if type(op) in REUSABLE_COMMANDS:
+            key = command_key(op, numbers)
+            intact = [name for name in holders[key] if numbers[name] == values[key] and name not in op.writes]
+            if len(intact) > 0:
+                op = Copy(coord=op.coord, from_name=intact[0], to_name=op.writes[0])
+
+        changed = op.consumes + op.writes
+        if type(op) == SetAddressableValue:
+            changed.append(op.base_name)
+        for name in changed:
+            numbers[name] = new_number()
+
+        if key is not None:
+            if key not in values:
+                values[key] = new_number()
+            numbers[op.writes[0]] = values[key]
+            holders[key].append(op.writes[0])
+
+        result.append(op)
+
+    return result
+
+
+# commands that clear the cells they write before writing them, rather than adding to them
+CLEARING_COMMANDS = (SetValue, SetArrayValues, AddressOf, Zero, Input)
+
+# commands that do something besides changing the cells they're given
+EFFECTFUL_COMMANDS = (Print, PrintString, Input, SetAddressableValue, EndProgram, WhileLoop)
+
+
+def command_effects(op, variables):
+    # the names whose values a command depends on, and the names it changes. Commands that add to
+    # their results depend on what's already there.
+    if type(op) == WhileLoop:
+        # the commands inside can run any number of times, even none, so everything they change
+        # depends on itself
+        changes = op.consumes + op.writes
+        uses = [op.cond_name] + changes
+        for inner in op.cond_ops + op.body_ops:
+            uses = uses + command_effects(inner, variables)[0]
+        return uses, changes
+
+    uses = op.reads + op.consumes
+    changes = op.consumes + op.writes
+    if type(op) not in CLEARING_COMMANDS:
+        uses = uses + op.writes
+    if type(op) in (GetAddressableValue, SetAddressableValue):
+        uses = uses + [op.base_name]
+    if type(op) == SetAddressableValue:
+        changes = changes + [op.base_name]
+    if type(op) == PrintString:
+        # prints from an address, which can be anywhere in memory
+        uses = uses + variables
+    return uses, changes
+
+
+def block_steps(block, variables):
+    # each command in a block with what it uses and changes; an if block ends by consuming its
+    # condition, which is given as a step without a command
+    if isinstance(block, IfBlock):
+        steps = [(op,) + command_effects(op, variables) for op in block.cond_block]
+        return steps + [(None, [block.decl_name], [block.decl_name] if is_temp(block.decl_name) else [])]
+    return [(op,) + command_effects(op, variables) for op in block.ops]
+
+
+def set_block_ops(block, ops):
+    if isinstance(block, IfBlock):
+        block.cond_block = ops
+    else:
+        block.ops = ops
+
+
+def successors(block):
+    if isinstance(block, IfBlock):
+        return [block.true_blocks[0], block.false_blocks[0]]
+    elif block.next_index is not None:
+        return [block.next_index]
+    return []
+
+
+def resolve_constant_ifs(blocks_by_index):
+    # an if whose condition is a constant becomes a jump to the branch it always takes
+    for index, block in list(blocks_by_index.items()):
+        if (isinstance(block, IfBlock) and len(block.cond_block) == 1 and type(block.cond_block[0]) == SetValue
+                and block.cond_block[0].name == block.decl_name):
+            cond = block.cond_block[0]
+            jump = Block(index)
+            jump.next_index = block.true_blocks[0] if constant_value(cond.value, cond.type) else block.false_blocks[0]
+            blocks_by_index[index] = jump
+
+
+def remove_unreachable_blocks(blocks_by_index, entry_index):
+    reachable = set()
+    pending = [entry_index]
+    while len(pending) > 0:
+        index = pending.pop()
+        if index not in reachable:
+            reachable.add(index)
+            pending.extend(successors(blocks_by_index[index]))
+
+    for index in list(blocks_by_index):
+        if index not in reachable:
+            del blocks_by_index[index]
+
+
+def remove_dead_stores(blocks_by_index, variables):
+    # drops commands that only change names nothing uses afterwards, working backwards from the end
+    # of the program, where every variable is used. Returns whether any were dropped.
+    live_in = dict((index, set()) for index in blocks_by_index)
+
+    def live_out(block):
+        if isinstance(block, EndBlock):
+            return set(variables)
+        return set().union(*[live_in[index] for index in successors(block)])
+
+    changed = True
+    while changed:
+        changed = False
+        for index, block in blocks_by_index.items():
+            live = live_out(block)
+            for op, uses, changes in reversed(block_steps(block, variables)):
+                live = (live - set(changes)) | set(uses)
+            if live != live_in[index]:
+                live_in[index] = live
+                changed = True
+
+    removed = False
+    for block in blocks_by_index.values():
+        live = live_out(block)
+        kept = []
+        for op, uses, changes in reversed(block_steps(block, variables)):
+            # a temp is zero whenever it isn't in use, so clearing one is never dead
+            restores_temp = type(op) == Zero and is_temp(op.name)
+            if (op is not None and type(op) not in EFFECTFUL_COMMANDS and not restores_temp and
+                    len(set(changes) & live) == 0):
+                removed = True
+                continue
+
+            if op is not None:
+                # a temp whose only users were dropped has to be cleared again
+                kept.extend(Zero(coord=op.coord, name=name) for name in op.writes
+                            if is_temp(name) and name not in live)
+                kept.append(op)
+
+            live = (live - set(changes)) | set(uses)
+
+        set_block_ops(block, list(reversed(kept)))
+
+    return removed
+
+
+def remove_redundant_zeros(blocks_by_index, entry_index, names, variables):
+    # follows which names are known to be zero, which they all are when the program starts, and
+    # drops Zeros and SetValues of 0 on them. Clears of temps are kept, as live_ranges only shares a
+    # temp's cell when the temp is written before it's read.
+    def is_clear(op):
+        return type(op) == Zero or (type(op) == SetValue and constant_value(op.value, op.type) == 0)
+
+    def transfer(block, zeros, remove):
+        kept = []
+        for op, uses, changes in block_steps(block, variables):
+            if (op is not None and is_clear(op) and len(set(changes) - zeros) == 0 and
+                    not any(is_temp(name) for name in changes)):
+                if remove:
+                    continue
+            consumed = op.consumes if op is not None else changes
+            for name in changes:
+                if name in consumed or is_clear(op):
+                    zeros.add(name)
+                else:
+                    zeros.discard(name)
+            if op is not None:
+                kept.append(op)
+        if remove:
+            set_block_ops(block, kept)
+        return zeros
+
+    predecessors = dict((index, []) for index in blocks_by_index)
+    for index, block in blocks_by_index.items():
+        for successor in successors(block):
+            predecessors[successor].append(index)
+
+    zeros_out = dict((index, set(names)) for index in blocks_by_index)
+
+    def zeros_in(index):
+        zeros = set(names)
+        for predecessor in predecessors[index]:
+            zeros &= zeros_out[predecessor]
+        return zeros
+
+    changed = True
+    while changed:
+        changed = False
+        for index, block in blocks_by_index.items():
+            zeros = transfer(block, zeros_in(index), False)
+            if zeros != zeros_out[index]:
+                zeros_out[index] = zeros
+                changed = True
+
+    for index, block in blocks_by_index.items():
+        transfer(block, zeros_in(index), True)
+
+
+def eliminate_dead_code(blocks_by_index, entry_index, names, variables):
+    resolve_constant_ifs(blocks_by_index)
+    remove_unreachable_blocks(blocks_by_index, entry_index)
+    while remove_dead_stores(blocks_by_index, variables):
+        pass
+    remove_redundant_zeros(blocks_by_index, entry_index, names, variables)
+
+
+# join blocks with at most this many commands are copied into the blocks that jump to them
+INLINE_JOIN_SIZE = 4
+
+
+def block_ops(block):
+    return block.cond_block if isinstance(block, IfBlock) else block.ops
+
+
+def count_predecessors(blocks_by_index):
+    predecessors = Counter()
+    for block in blocks_by_index.values():
+        predecessors.update(successors(block))
+    return predecessors
+
+
+def merge_chains(blocks_by_index, entry_index):
+    # a block that's the only way into the block after it takes that block's place, running both
+    # without going back to the dispatcher in between. Returns whether any were merged.
+    predecessors = count_predecessors(blocks_by_index)
+    merged = False
+    for index, block in list(blocks_by_index.items()):
+        if blocks_by_index.get(index) is not block or type(block) != Block or block.next_index is None:
+            continue
+
+        next_index = block.next_index
+        if next_index in (index, entry_index) or predecessors[next_index] != 1:
+            continue
+
+        next_block = blocks_by_index.pop(next_index)
+        set_block_ops(next_block, block.ops + block_ops(next_block))
+        next_block.index = index
+        blocks_by_index[index] = next_block
+        merged = True
+
+    return merged
+
+
+def inline_joins(blocks_by_index, entry_index):
+    # a small block that several others jump to, like the one after an if, is copied onto the end
+    # of each of those that are plain blocks, which then jump where it would have. When it's an if
+    # itself, they become copies of it that start with their own commands.
+    predecessors = count_predecessors(blocks_by_index)
+    for join_index, join in list(blocks_by_index.items()):
+        if (type(join) not in (Block, IfBlock, LoopBlock) or join_index == entry_index or predecessors[join_index] < 2 or
+                len(block_ops(join)) > INLINE_JOIN_SIZE):
+            continue
+
+        for index, block in list(blocks_by_index.items()):
+            if type(block) != Block or block.next_index != join_index or block is join:
+                continue
+
+            if isinstance(join, IfBlock):
+                blocks_by_index[index] = IfBlock(index, block.ops + join.cond_block, list(join.true_blocks),
+                                                 list(join.false_blocks), join.decl_name)
+            else:
+                block.ops = block.ops + join.ops
+                block.next_index = join.next_index
+
+
+def merge_blocks(blocks_by_index, entry_index):
+    while merge_chains(blocks_by_index, entry_index):
+        pass
+    inline_joins(blocks_by_index, entry_index)
+    remove_unreachable_blocks(blocks_by_index, entry_index)
+    while merge_chains(blocks_by_index, entry_index):
+        pass
+
+
+def loop_depths(successors_by_index, entry_index):
+    # how many loops each block is in. A loop is found by an edge back to a block that's still
+    # being searched from, and is made up of the blocks that reach the edge without going through
+    # the block it goes back to.
+    predecessors = defaultdict(list)
+    for index, successors in successors_by_index.items():
+        for successor in successors:
+            predecessors[successor].append(index)
+
+    back_edges = []
+    visited = set([entry_index])
+    path = [entry_index]
+    pending = [iter(successors_by_index[entry_index])]
+    while len(pending) > 0:
+        successor = next(pending[-1], None)
+        if successor is None:
+            path.pop()
+            pending.pop()
+        elif successor in path:
+            back_edges.append((path[-1], successor))
+        elif successor not in visited:
+            visited.add(successor)
+            path.append(successor)
+            pending.append(iter(successors_by_index[successor]))
+
+    depths = Counter()
+    for tail, head in back_edges:
+        body = set([head])
+        unvisited = [tail]
+        while len(unvisited) > 0:
+            index = unvisited.pop()
+            if index not in body:
+                body.add(index)
+                unvisited.extend(predecessors[index])
+        for index in body:
+            depths[index] += 1
+
+    return depths
+
+
+def layout_blocks(successors_by_index, entry_index):
+    # orders blocks so that as many of them as possible are followed by the block they jump to,
+    # which the linear dispatcher reaches without counting past any others. Jumps are taken
+    # heaviest first, each a tenth as likely per loop it leaves, and join the chain of blocks ending
+    # with its source to the one starting with its target. Ties go to whichever comes first, so
+    # the true branch of an if before the false one.
+    depths = loop_depths(successors_by_index, entry_index)
+    jumps = [(index, successor) for index, successors in successors_by_index.items() for successor in successors]
+    jumps.sort(key=lambda jump: -10 ** min(depths[jump[0]], depths[jump[1]]))
+
+    chains = dict((index, [index]) for index in successors_by_index)
+    for index, successor in jumps:
+        chain, next_chain = chains[index], chains[successor]
+        if chain is not next_chain and chain[-1] == index and next_chain[0] == successor:
+            chain.extend(next_chain)
+            for joined_index in next_chain:
+                chains[joined_index] = chain
+
+    # the chains go in the order their blocks are first reached from the entry
+    order = []
+    pending = [entry_index]
+    while len(pending) > 0:
+        index = pending.pop()
+        if index not in order:
+            order.extend(chains[index])
+            for chain_index in reversed(chains[index]):
+                pending.extend(reversed(successors_by_index[chain_index]))
+
+    return order + sorted(index for index in successors_by_index if index not in order)
+
+
+def dispatch_cells(count):
+    # cells for the tree dispatcher: the IP workspace, nearest the stack first, and then the bottom
+    # of the stack
+    workspace = list(range(TapeIndices.END_IP_WORKSPACE, TapeIndices.START_IP_WORKSPACE - 1, -1))
+    return (workspace + list(range(TapeIndices.START_STACK, TapeIndices.START_STACK + count)))[:count]
+
+
 class DeclarationMapper:
-    def __init__(self, declarations):
+    def __init__(self, declarations, blocks=None, use_counts=None, reserved=0):
+        # use_counts, as returned by declaration_use_counts, places the most used declarations
+        # closest to the stack and those used together next to each other; otherwise they're
+        # placed in the order they were declared. The first reserved cells of the stack are left
+        # out, for the block dispatcher.
         self.positions = {}
-        position_offset = 0
-        for decl in filter(lambda decl: '~' in decl.name, declarations):
-            position = position_offset
-            self.positions[decl.name] = MappedDeclaration(declaration=decl, position=position)
-            position_offset += decl.size
+        declarations_by_name = dict((decl.name, decl) for decl in declarations)
+
+        temps = [decl for decl in declarations if '~' in decl.name]
+        if blocks is None:
+            temp_slots = [Slot(size=decl.size, shared=False, names=[decl.name]) for decl in temps]
+        else:
+            temp_slots = self.share_temp_slots(temps, blocks)
+
+        lvalue_slots = [Slot(size=decl.size, shared=False, names=[decl.name])
+                        for decl in declarations if '~' not in decl.name]
+
+        if use_counts is not None:
+            temp_slots = order_by_use(temp_slots, *use_counts)
+            lvalue_slots = order_by_use(lvalue_slots, *use_counts)
+
+        position_offset = reserved
+        for slot in temp_slots:
+            for name in slot.names:
+                self.positions[name] = MappedDeclaration(declaration=declarations_by_name[name], position=position_offset)
+            position_offset += slot.size
 
         self.stack_size = position_offset
 
+        # commands use the cells past the last temp as scratch space, which has to fit in the stack
+        if blocks is not None:
+            scratch_size = max([op.scratch_size for block in blocks for op in block_ops(block)], default=0)
+            available = TapeIndices.END_STACK - TapeIndices.START_STACK + 1
+            if self.stack_size + scratch_size > available:
+                raise Exception('Program needs {} stack cells for its temps and scratch space, but there are only {}'
+                                .format(self.stack_size + scratch_size, available))
+
         position_offset = 0
-        for decl in filter(lambda decl: '~' not in decl.name, declarations):
+        for slot in lvalue_slots:
             position = (TapeIndices.START_LVALUES - TapeIndices.START_STACK) + position_offset * 3 + 2
-            self.positions[decl.name] = MappedDeclaration(declaration=decl, position=position)
-            position_offset += decl.size
+            for name in slot.names:
+                self.positions[name] = MappedDeclaration(declaration=declarations_by_name[name], position=position)
+            position_offset += slot.size
 
         self.total_size = position_offset
 
+    def share_temp_slots(self, temps, blocks):
+        # a temp that's consumed at the end of every range it's live in leaves its cell zeroed, like
+        # a new one, so it can share the cell with other such temps that aren't live at the same
+        # time. Any other temp gets a cell of its own, and temps that are never used don't get one.
+        ranges, dirty = live_ranges(blocks)
+        slots = []
+
+        for decl in temps:
+            if decl.name not in ranges:
+                continue
+
+            shared = decl.name not in dirty and decl.size == 1
+            slot = None
+            if shared:
+                for candidate in slots:
+                    if candidate.shared and not any(ranges_interfere(ranges[decl.name], ranges[name])
+                                                    for name in candidate.names):
+                        slot = candidate
+                        break
+
+            if slot is None:
+                slot = Slot(size=decl.size, shared=shared, names=[])
+                slots.append(slot)
+
+            slot.names.append(decl.name)
+
+        return slots
+
     def __getitem__(self, lvalue):
         if type(lvalue) == int:
             return MappedDeclaration(declaration=Declaration(kind=None, name=None), position=lvalue)
@@ -189,7 +864,12 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
     def push_sub_decl(self, suffix):
         stack_top = self.decl_name_stack[-1]
         decl_name = '{}~{}'.format(stack_top.name, suffix)
-        self.push_decl(decl_name, stack_top.kind)
+
+        # a temp holds a single value, even when it's part of assigning to an array
+        kind = stack_top.kind
+        if type(kind) == c_ast.ArrayDecl:
+            kind = kind.type
+        self.push_decl(decl_name, kind)
         return decl_name
 
     def push_decl(self, decl_name, kind=None):
@@ -200,6 +880,17 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
     def pop_decl(self):
         self.decl_name_stack.pop()
 
+    def visit_operand(self, node, suffix):
+        # a plain variable is read where it is by the command using it, which copies it; anything
+        # else is evaluated into a temp under the current declaration
+        if type(node) == c_ast.ID:
+            return [], node.name
+
+        decl_name = self.push_sub_decl(suffix)
+        ops = list(self.visit_child(node))
+        self.pop_decl()
+        return ops, decl_name
+
     def visit_assignment_body(self, coord, result_node, assignment_body):
         ops = []
 
@@ -208,18 +899,25 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
         if hasattr(result_node, 'lvalue') and type(result_node.lvalue) == c_ast.ArrayRef:
             base_name, subscripts = parse_array_ref(result_node.lvalue)
 
-            subscript_name = '{}~sub~0'.format(base_name)
-            self.push_decl(subscript_name)
-
-            ops += list(self.visit_child(subscripts[0]))
+            # the offset is only read, so a variable can be used where it is
+            if type(subscripts[0]) == c_ast.ID:
+                subscript_name = subscripts[0].name
+            else:
+                subscript_name = '{}~sub~0'.format(base_name)
+                self.push_decl(subscript_name)
+                ops += list(self.visit_child(subscripts[0]))
+                self.pop_decl()
 
             rvalue_name = '{}~rvalue~0'.format(base_name)
             self.push_decl(rvalue_name)
 
-            ops += list(self.visit_child(result_node.rvalue))
+            ops += list(self.visit_child(assignment_body))
             ops += [SetAddressableValue(coord=coord, base_name=base_name, offset_name=subscript_name, rvalue_name=rvalue_name)]
 
-            self.pop_decl()
+            # the offset is only read, so a temp holding it is cleared to let its cell be shared
+            if is_temp(subscript_name):
+                ops.append(Zero(coord=coord, name=subscript_name))
+
             self.pop_decl()
 
         # otherwise, we can simply assign to the variable's static location
@@ -231,8 +929,21 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
             else:
                 raise Exception('Unsupported type %s', type(result_node.lvalue))
 
+            # the variable is already declared, so it's only pushed for the expression's commands to
+            # write to, or to name the temp they write to
+            self.decl_name_stack.append(Declaration(name=result, kind=None))
+
             if type(assignment_body) == c_ast.InitList:
                 ops += list(self.visit_child(assignment_body))
+
+            # an expression that doesn't use the variable can be evaluated straight into it. Constants
+            # and variables are set and copied into it by SetValue and visit_ID, which clear it first;
+            # everything else adds to it.
+            elif not references(assignment_body, result):
+                if type(assignment_body) not in (c_ast.Constant, c_ast.ID) and fold_constant(assignment_body) is None:
+                    ops.append(Zero(coord=coord, name=result))
+                ops += list(self.visit_child(assignment_body))
+
             else:
                 decl_name = self.push_decl_mod(result)
 
@@ -244,13 +955,20 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
 
                 self.pop_decl()
 
+            self.pop_decl()
+
         return ops
 
     def visit_Assignment(self, node):
         self.lprint(node.__class__.__name__, node.coord)
         self.aprint('name', node.lvalue)
 
-        return self.visit_assignment_body(str(node.coord), node, node.rvalue)
+        # x op= y is x = x op y
+        rvalue = node.rvalue
+        if node.op != '=':
+            rvalue = c_ast.BinaryOp(node.op[:-1], node.lvalue, node.rvalue, node.coord)
+
+        return self.visit_assignment_body(str(node.coord), node, rvalue)
 
     def visit_InitList(self, node):
         self.lprint(node.__class__.__name__, node.coord)
@@ -265,47 +983,95 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
         result_name = self.decl_name_stack[-1].name
         base_name, subscripts = parse_array_ref(node)
 
-        subscript_name = '{}~sub~0'.format(base_name)
-        self.push_decl(subscript_name)
-
-        ops = list(self.visit_child(subscripts[0]))
+        if type(subscripts[0]) == c_ast.ID:
+            subscript_name = subscripts[0].name
+            ops = []
+        else:
+            # named after the result, so it can't be the subscript of an array store it's part of
+            subscript_name = self.push_sub_decl('sub')
+            ops = list(self.visit_child(subscripts[0]))
+            self.pop_decl()
 
         ops += [
             GetAddressableValue(coord=str(node.coord), base_name=base_name,
                                 offset_name=subscript_name, result_name=result_name)
         ]
+        if is_temp(subscript_name):
+            ops.append(Zero(coord=str(node.coord), name=subscript_name))
         return ops
 
     def visit_BinaryOp(self, node):
         self.lprint(node.__class__.__name__, node.coord)
         self.aprint('op', node.op)
 
-        ops = []
-
-        first_name = self.push_sub_decl('a')
-        ops.extend(self.visit_child(node.left))
-        self.pop_decl()
-
-        second_name = self.push_sub_decl('b')
-        ops.extend(self.visit_child(node.right))
-        self.pop_decl()
+        result_name = self.decl_name_stack[-1].name
 
-        if node.op == '+':
-            op_class = Add
-        elif node.op == '*':
-            op_class = Multiply
-        elif node.op == '>=':
-            op_class = GreaterOrEqual
-        elif node.op == '>':
-            op_class = Greater
-        elif node.op == '<=':
-            op_class = LesserOrEqual
-        elif node.op == '<':
-            op_class = Lesser
-        else:
+        if node.op in ('/', '%') and fold_constant(node.right) == 0:
+            raise Exception('Division by zero at {}'.format(node.coord))
+
+        value = fold_constant(node)
+        if value is not None:
+            return [SetValue(coord=str(node.coord), name=result_name, value=str(value), type='int')]
+
+        first_value = fold_constant(node.left)
+        second_value = fold_constant(node.right)
+
+        # x*0 is 0, as long as evaluating x doesn't do anything else
+        if node.op == '*' and ((first_value == 0 and not has_side_effects(node.right)) or
+                               (second_value == 0 and not has_side_effects(node.left))):
+            return [SetValue(coord=str(node.coord), name=result_name, value='0', type='int')]
+
+        # so are x%1, 0/x and 0%x
+        if ((node.op == '%' and second_value == 1 and not has_side_effects(node.left)) or
+                (node.op in ('/', '%') and first_value == 0 and not has_side_effects(node.right))):
+            return [SetValue(coord=str(node.coord), name=result_name, value='0', type='int')]
+
+        # x*1, x/1 and x+0 are x, which can be evaluated straight into the result
+        left_identity = {'*': 1, '+': 0}.get(node.op)
+        right_identity = {'*': 1, '/': 1, '+': 0}.get(node.op)
+        if left_identity is not None and first_value == left_identity:
+            return self.visit_child(node.right)
+        if right_identity is not None and second_value == right_identity:
+            return self.visit_child(node.left)
+
+        # multiplying by a constant adds it to the result once for each unit of the other operand,
+        # rather than copying the constant each time
+        if node.op == '*' and (first_value is not None or second_value is not None):
+            if first_value is not None:
+                operand, factor = node.right, first_value
+            else:
+                operand, factor = node.left, second_value
+
+            ops, operand_name = self.visit_operand(operand, 'a')
+            ops.append(MultiplyConstant(coord=str(node.coord), result_name=result_name,
+                                        operand_name=operand_name, factor=factor))
+            return ops
+
+        # a constant divisor is set straight into the divmod's scratch cells
+        if node.op in ('/', '%') and second_value is not None:
+            ops, operand_name = self.visit_operand(node.left, 'a')
+            op_class = DivideConstant if node.op == '/' else ModuloConstant
+            ops.append(op_class(coord=str(node.coord), result_name=result_name,
+                                operand_name=operand_name, divisor=second_value))
+            return ops
+
+        first_ops, first_name = self.visit_operand(node.left, 'a')
+        second_ops, second_name = self.visit_operand(node.right, 'b')
+        ops = first_ops + second_ops
+
+        if node.op not in BINARY_OPS:
             raise Exception('Unknown binary op {}'.format(node.op))
 
-        ops.append(op_class(coord=str(node.coord), result_name=self.decl_name_stack[-1].name,
+        # Multiply copies its second operand once for each unit of its first, so the one known to
+        # be smaller goes first
+        if node.op == '*':
+            first_bound = value_bound(node.left)
+            second_bound = value_bound(node.right)
+            if second_bound is not None and (first_bound is None or second_bound < first_bound):
+                first_name, second_name = second_name, first_name
+
+        op_class = BINARY_OPS[node.op][0]
+        ops.append(op_class(coord=str(node.coord), result_name=result_name,
                             first_name=first_name, second_name=second_name))
 
         return ops
@@ -320,6 +1086,21 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
             ops.append(AddressOf(coord=str(node.coord), result_name=self.decl_name_stack[-1].name,
                                  expr=node.expr))
 
+        elif node.op in INCREMENTS:
+            if type(node.expr) != c_ast.ID:
+                raise Exception('Unsupported type {} for {} operator'.format(type(node.expr), node.op))
+
+            amount, postfix = INCREMENTS[node.op]
+            ops.append(Increment(coord=str(node.coord), name=node.expr.name, amount=amount))
+
+            # on its own, as a statement, there's no value to give
+            if len(self.decl_name_stack) > 0:
+                value_ops = self.visit_child(node.expr)
+                ops = value_ops + ops if postfix else ops + value_ops
+
+        else:
+            raise Exception('Unknown unary op {}'.format(node.op))
+
         return ops
 
     def visit_Compound(self, node):
@@ -332,10 +1113,12 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
             if isinstance(result, IfBlock):
                 next_block = self.create_block()
 
-                self.blocks_by_index[result.true_blocks[-1]].next_index = next_block.index
+                # a loop's body already jumps back to its test
+                if not isinstance(result, LoopBlock):
+                    self.blocks_by_index[result.true_blocks[-1]].next_index = next_block.index
                 self.blocks_by_index[result.false_blocks[-1]].next_index = next_block.index
 
-                blocks[-1].next_index = result.index
+                blocks[-1].next_index = result.entry_index if isinstance(result, LoopBlock) else result.index
                 blocks.append(result)
                 blocks.append(next_block)
             else:
@@ -363,10 +1146,12 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
 
         self.push_decl(node.name, node.type)
 
+        ops = []
         if node.init:
-            return self.visit_assignment_body(str(node.coord), node.name, node.init)
-        else:
-            return []
+            ops = self.visit_assignment_body(str(node.coord), node.name, node.init)
+
+        self.pop_decl()
+        return ops
 
     def visit_ID(self, node):
         self.lprint(node.__class__.__name__, node.coord)
@@ -380,14 +1165,19 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
     def visit_If(self, node):
         self.lprint(node.__class__.__name__, node.coord)
 
-        result_name = 'if'
-        self.push_decl(result_name)
-        decl_name = self.push_decl_mod(result_name)
+        # a variable is branched on where it is
+        if type(node.cond) == c_ast.ID:
+            decl_name = node.cond.name
+            cond_block = []
+        else:
+            result_name = 'if'
+            self.push_decl(result_name)
+            decl_name = self.push_decl_mod(result_name)
 
-        cond_block = self.visit_child(node.cond)
+            cond_block = self.visit_child(node.cond)
 
-        self.pop_decl()
-        self.pop_decl()
+            self.pop_decl()
+            self.pop_decl()
 
         true_blocks = [block.index for block in self.visit_child(node.iftrue)]
         if node.iffalse:
@@ -404,6 +1194,101 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
 
         return [if_block]
 
+    def visit_condition(self, cond, prefix, in_place):
+        # a loop condition is evaluated into a temp under prefix, which isn't itself declared. When
+        # in_place is set, a plain variable is tested where it is instead. A missing condition, as
+        # in for (;;), is always true.
+        if cond is None:
+            cond = c_ast.Constant('int', '1')
+
+        if in_place and type(cond) == c_ast.ID:
+            return cond.name, []
+
+        self.decl_name_stack.append(Declaration(name=prefix, kind=None))
+        decl_name = self.push_decl_mod(prefix)
+
+        ops = list(self.visit_child(cond))
+
+        self.pop_decl()
+        self.pop_decl()
+        return decl_name, ops
+
+    def visit_loop(self, node, prefix, test_first, next_node=None):
+        # a loop whose body has no other control flow in it becomes a single WhileLoop command,
+        # running as a native loop inside the block it's in. Any other loop is tested by a
+        # LoopBlock, and goes back through the dispatcher on every pass.
+        body = node.stmt
+        if type(body) != c_ast.Compound:
+            body = c_ast.Compound([body], body.coord)
+
+        first_block_index = self.next_block_index
+        body_blocks = self.visit_child(body)
+        next_ops = list(self.visit_child(next_node)) if next_node is not None else []
+        native = len(body_blocks) == 1
+
+        # the test at the top of a native do-while has to consume its condition, so it can be
+        # entered with the condition set
+        cond_name, cond_ops = self.visit_condition(node.cond, prefix, not native or test_first)
+
+        if native:
+            body_ops = body_blocks[0].ops + next_ops
+            del self.blocks_by_index[body_blocks[0].index]
+
+            return [WhileLoop(coord=str(node.coord), cond_name=cond_name,
+                              cond_ops=clean_temps(str(node.coord), cond_ops, cond_name),
+                              body_ops=clean_temps(str(node.coord), body_ops), test_first=test_first)]
+
+        # the temps are zeroed on every pass, so the next one finds them clean. Every block the
+        # body was visited into is part of it, except those loops inside it took back.
+        body_blocks[-1].ops += next_ops
+        for index in range(first_block_index, self.next_block_index):
+            block = self.blocks_by_index.get(index)
+            if block is None:
+                continue
+            elif isinstance(block, IfBlock):
+                block.cond_block = clean_temps(str(node.coord), block.cond_block, block.decl_name)
+            else:
+                block.ops = clean_temps(str(node.coord), block.ops)
+        cond_ops = clean_temps(str(node.coord), cond_ops, cond_name)
+
+        exit_block = self.create_block()
+        loop_index = self.next_block_index
+        loop_block = LoopBlock(
+            loop_index,
+            decl_name = cond_name,
+            cond_block = cond_ops,
+            true_blocks = [block.index for block in body_blocks],
+            false_blocks = [exit_block.index],
+            entry_index = loop_index if test_first else body_blocks[0].index
+        )
+        self.add_block(loop_block)
+
+        body_blocks[-1].next_index = loop_index
+
+        return [loop_block]
+
+    def visit_While(self, node):
+        self.lprint(node.__class__.__name__, node.coord)
+        return self.visit_loop(node, 'while', True)
+
+    def visit_DoWhile(self, node):
+        self.lprint(node.__class__.__name__, node.coord)
+        return self.visit_loop(node, 'do', False)
+
+    def visit_For(self, node):
+        self.lprint(node.__class__.__name__, node.coord)
+
+        ops = list(self.visit_child(node.init)) if node.init is not None else []
+        return ops + self.visit_loop(node, 'for', True, node.next)
+
+    def visit_Break(self, node):
+        # a loop's body has to run to its end, whether it's a WhileLoop or a LoopBlock, so there's
+        # nowhere for these to jump to
+        raise Exception('Unsupported break statement at {}'.format(node.coord))
+
+    def visit_Continue(self, node):
+        raise Exception('Unsupported continue statement at {}'.format(node.coord))
+
     def visit_FuncCall(self, node):
         self.lprint(node.__class__.__name__, node.coord)
         self.aprint('name', node.name.name)
@@ -428,29 +1313,40 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
             arg_index = 0
             arg = node.args.exprs[arg_index]
 
-            arg_name = '{}~arg~{}'.format(function_name, arg_index)
-            self.push_decl(arg_name)
-            decl_name = self.push_decl_mod(arg_name)
+            # a variable is printed from where it is
+            if type(arg) == c_ast.ID:
+                ops += [Print(coord=str(node.coord), output_name=arg.name)]
+            else:
+                arg_name = '{}~arg~{}'.format(function_name, arg_index)
+                self.push_decl(arg_name)
+                decl_name = self.push_decl_mod(arg_name)
 
-            ops += list(self.visit_child(arg))
-            ops += [Print(coord=str(node.coord), output_name=decl_name)]
+                ops += list(self.visit_child(arg))
+                ops += [Print(coord=str(node.coord), output_name=decl_name)]
+                # the argument is only read, so it's cleared to let its cell be shared
+                ops += [Zero(coord=str(node.coord), name=decl_name)]
 
-            self.pop_decl()
-            self.pop_decl()
+                self.pop_decl()
+                self.pop_decl()
 
         elif function_name == 'puts':
             arg_index = 0
             arg = node.args.exprs[arg_index]
 
-            arg_name = '{}~arg~{}'.format(function_name, arg_index)
-            self.push_decl(arg_name)
-            decl_name = self.push_decl_mod(arg_name)
+            if type(arg) == c_ast.ID:
+                ops += [PrintString(coord=str(node.coord), output_name=arg.name)]
+            else:
+                arg_name = '{}~arg~{}'.format(function_name, arg_index)
+                self.push_decl(arg_name)
+                decl_name = self.push_decl_mod(arg_name)
 
-            ops += list(self.visit_child(arg))
-            ops += [PrintString(coord=str(node.coord), output_name=decl_name)]
+                ops += list(self.visit_child(arg))
+                ops += [PrintString(coord=str(node.coord), output_name=decl_name)]
+                # the argument is only read, so it's cleared to let its cell be shared
+                ops += [Zero(coord=str(node.coord), name=decl_name)]
 
-            self.pop_decl()
-            self.pop_decl()
+                self.pop_decl()
+                self.pop_decl()
 
         else:
             raise Exception('Unknown function call {}'.format(function_name))
@@ -464,25 +1360,61 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
 
         return []
 
-    def to_bf(self):
+    def to_bf(self, peephole=True, color=True, placement=None, cse=True, dce=True, merge=True, dispatch='linear',
+              layout=True):
+        # cse reuses the results of expensive commands computed earlier in the same block. dce
+        # removes unreachable blocks, stores that are never used and Zeros of cells already zero.
+        # merge joins blocks to the only block that jumps to them, and copies small join blocks
+        # into the blocks before them.
+        # layout orders blocks so each is followed by the one it most likely jumps to.
+        # placement lays out declarations by how often they're used: 'static' counts the commands
+        # using each one, and a dict from BrainfuckRuntime.profile_declarations counts the
+        # instructions that touched each one in a previous run. dispatch picks how the next block
+        # is found: 'linear' counts the IP down past every block in turn, and 'tree' keeps it in
+        # binary and branches on one bit at a time, so a jump costs the log of the block count.
         print()
-
-        declaration_mapper = DeclarationMapper(self.declarations)
+        self.peephole_stats = Counter()
 
         end_block = self.create_end_block()
         for block in self.blocks_by_index.values():
             if isinstance(block, Block) and not isinstance(block, EndBlock) and block.next_index is None:
                 block.next_index = end_block.index
 
+        if cse:
+            for block in self.blocks_by_index.values():
+                if isinstance(block, IfBlock):
+                    block.cond_block = eliminate_common_subexpressions(block.cond_block)
+                else:
+                    block.ops = eliminate_common_subexpressions(block.ops)
+
+        main_blocks = self.functions['main']
+        if dce:
+            names = [decl.name for decl in self.declarations]
+            variables = [name for name in names if not is_temp(name)]
+            eliminate_dead_code(self.blocks_by_index, main_blocks[0].index, names, variables)
+
+        if merge:
+            merge_blocks(self.blocks_by_index, main_blocks[0].index)
+
+        blocks = list(self.blocks_by_index.values())
+        if placement is None:
+            use_counts = None
+        elif placement == 'static':
+            use_counts = declaration_use_counts(blocks)
+        else:
+            use_counts = declaration_use_counts(blocks, placement)
+
         print('blocks_by_index:')
-        for index in range(len(self.blocks_by_index)):
-            block = self.blocks_by_index[index]
+        for index, block in sorted(self.blocks_by_index.items()):
             print('%d: %s' % (index, block))
         print()
 
         blocks_to_terminal_blocks = {}
         def find_terminal_blocks(block_indexes):
             for block_index in block_indexes:
+                # loops lead back to blocks already seen
+                if block_index in blocks_to_terminal_blocks:
+                    continue
                 block = self.blocks_by_index[block_index]
 
                 if isinstance(block, EndBlock):
@@ -490,8 +1422,8 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
 
                 elif isinstance(block, IfBlock):
                     blocks_to_terminal_blocks[block.index] = block.index
-                    find_terminal_blocks(block.true_blocks)
-                    find_terminal_blocks(block.false_blocks)
+                    find_terminal_blocks([block.true_blocks[0]])
+                    find_terminal_blocks([block.false_blocks[0]])
 
                 else:
                     if len(block.ops) == 0:
@@ -502,8 +1434,7 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
                     if block.next_index:
                         find_terminal_blocks([block.next_index])
 
-        main_blocks = self.functions['main']
-        find_terminal_blocks([block.index for block in main_blocks])
+        find_terminal_blocks([main_blocks[0].index])
 
         modified = True
         while modified:
@@ -521,12 +1452,18 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
 
         print('blocks_to_terminal_blocks', blocks_to_terminal_blocks)
 
-        terminal_blocks = set([b for b in blocks_to_terminal_blocks.values() if b is not None])
+        terminal_blocks = sorted(set([b for b in blocks_to_terminal_blocks.values() if b is not None]))
         print('terminal_blocks', terminal_blocks)
+        if layout:
+            terminal_successors = dict((index, [blocks_to_terminal_blocks[successor]
+                                                for successor in successors(self.blocks_by_index[index])
+                                                if blocks_to_terminal_blocks.get(successor) is not None])
+                                       for index in terminal_blocks)
+            terminal_blocks = layout_blocks(terminal_successors, blocks_to_terminal_blocks[main_blocks[0].index])
+
         blocks_to_minimal_blocks = {}
         for minimal_block_index, block_index in enumerate(terminal_blocks):
-            if block_index is not None:
-                blocks_to_minimal_blocks[block_index] = minimal_block_index
+            blocks_to_minimal_blocks[block_index] = minimal_block_index
 
         print('blocks_to_minimal_blocks', blocks_to_minimal_blocks)
 
@@ -561,7 +1498,19 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
                 block.false_blocks = [block_index for n, block_index in enumerate(block.false_blocks) if n == 0 or block.false_blocks[n-1] != block_index]
 
         def ip_offset(current_index, new_index):
-            return ((new_index - current_index) % len(new_blocks_by_index)) - 1
+            # a block that jumps to itself goes all the way around
+            return (new_index - current_index - 1) % len(new_blocks_by_index)
+
+        if dispatch == 'linear':
+            ip_bits = 0
+        elif dispatch == 'tree':
+            ip_bits = (len(new_blocks_by_index) - 1).bit_length()
+        else:
+            raise Exception('Unknown dispatch {}'.format(dispatch))
+
+        # the tree dispatcher's cells that don't fit in the IP workspace go at the bottom of the stack
+        reserved = len([pos for pos in dispatch_cells(ip_bits + 2) if pos >= TapeIndices.START_STACK])
+        declaration_mapper = DeclarationMapper(self.declarations, blocks, use_counts, reserved=reserved)
 
         print('main_blocks:')
         for block in main_blocks:
@@ -570,115 +1519,203 @@ class BrainfuckCompilerVisitor(c_ast.NodeVisitor):
 
         static_data_size = sum([len(data) for data in self.static_data]) + len(self.static_data)
         addressable_memory_size = TapeIndices.LVALUES_COUNT + static_data_size
-        output = format_bf('AddressableSetup', None, '{}{}{}<'.format(
-            bf_travel(TapeIndices.START, TapeIndices.START_ADDRESSABLE_MEMORY + 4),
-            '+3>' * addressable_memory_size,
-            str(3 * addressable_memory_size + 4)
-        ))
+        addressable_setup = [travel(TapeIndices.START, TapeIndices.START_ADDRESSABLE_MEMORY + 4)]
+        addressable_setup += [Change(1), Shift(3)] * addressable_memory_size
+        addressable_setup.append(Shift(-(3 * addressable_memory_size + 4)))
+        program = [section('AddressableSetup', *addressable_setup)]
 
         print('static_data:', self.static_data)
-        static_setup_section = '{} '.format(bf_travel(TapeIndices.START_ADDRESSABLE_MEMORY, TapeIndices.START_STATIC_SEGMENT))
+        static_setup = [travel(TapeIndices.START_ADDRESSABLE_MEMORY, TapeIndices.START_STATIC_SEGMENT)]
         for data_index, data in enumerate(self.static_data):
             for c in data:
-                static_setup_section += '>>{}+>'.format(str(ord(c)))
-            static_setup_section += '>>> ' # zero byte
+                static_setup += [Shift(2), Change(ord(c)), Shift(1)]
+            static_setup.append(Shift(3)) # zero byte
         static_segment_size = 3 * static_data_size
-        static_setup_section += '{}<'.format(static_segment_size)
-        static_setup_section += '{}'.format(bf_travel(TapeIndices.START_STATIC_SEGMENT, TapeIndices.START))
-        output += format_bf('StaticSetup', None, static_setup_section)
+        static_setup.append(Shift(-static_segment_size))
+        static_setup.append(travel(TapeIndices.START_STATIC_SEGMENT, TapeIndices.START))
+        program.append(section('StaticSetup', *static_setup))
 
         start_ip = blocks_to_new_blocks.get(main_blocks[0].index)
         print('start_ip', start_ip)
 
-        output += '{}+{}'.format(
-            bf_travel(TapeIndices.START, TapeIndices.STOP_INDICATOR_INDEX),
-            bf_travel(TapeIndices.STOP_INDICATOR_INDEX, TapeIndices.IP_INDEX))
-
-        output += format_bf('IPSetup', None, '!{}+ 3>+>+ 4<'.format(start_ip))
-        output += '{} [{}'.format(
-            bf_travel(TapeIndices.IP_INDEX, TapeIndices.STOP_INDICATOR_INDEX),
-            bf_travel(TapeIndices.STOP_INDICATOR_INDEX, TapeIndices.FIRST_KNOWN_ZERO))
-
-        symbol_table = OrderedDict()
-
-        print('new_blocks_by_index:')
-        for block_index, block in new_blocks_by_index.items():
-            print('%d: %s' % (block_index, block.pretty_print()))
-
-            start_bf_length = len(output)
-            output += '{} [{} '.format(
-                bf_travel(TapeIndices.FIRST_KNOWN_ZERO, TapeIndices.STOP_INDICATOR_INDEX),
-                bf_travel(TapeIndices.STOP_INDICATOR_INDEX, TapeIndices.IP_INDEX))
-            output += format_bf('IPCheck', None, '>+< [->->]3>[>] {}'.format(
-                bf_travel(TapeIndices.END_IP_WORKSPACE, TapeIndices.IP_ZERO_INDICATOR)))
-            output += '{}{} [-{}'.format(
-                bf_start_paren,
-                format_bf_name('Block'),
-                bf_travel(TapeIndices.IP_ZERO_INDICATOR, TapeIndices.START_STACK))
-            end_bf_length = len(output)
+        def block_body(block, set_ip):
+            # the block's commands, then the jump to the block after it, which set_ip(index, pos)
+            # makes from pos; set_ip(index, pos, old_index) changes a jump to old_index into one to
+            # index. Starts and ends at the start of the stack.
+            body = []
 
             if isinstance(block, IfBlock):
-                coord = block.cond_block[0].coord
-            elif len(block.ops) > 0:
-                coord = block.ops[0].coord
-            else:
-                coord = None
+                true_index, false_index = block.true_blocks[0], block.false_blocks[0]
+                cond_ops = block.cond_block
 
-            # if coord:
-            #     symbol_table[(start_bf_length, end_bf_length)] = coord
+                # a comparison the condition ends with jumps straight from its gadget, rather than
+                # leaving a result to test
+                fused = (is_temp(block.decl_name) and len(cond_ops) > 0 and
+                         type(cond_ops[-1]) in COMPARISON_COMMANDS and cond_ops[-1].result_name == block.decl_name)
+                if fused:
+                    cond_ops = cond_ops[:-1]
 
-            if isinstance(block, IfBlock):
-                for op in block.cond_block:
-                    start_bf_length = len(output)
-                    output += op.to_bf(declaration_mapper, declaration_mapper.stack_size)
-                    end_bf_length = len(output)
-                    symbol_table[(start_bf_length, end_bf_length)] = op.coord
+                for op in cond_ops:
+                    body.append(op.to_ir(declaration_mapper, declaration_mapper.stack_size))
 
-                true_ip = ip_offset(block.index, block.true_blocks[0])
-                false_ip = ip_offset(block.index, block.false_blocks[0])
+                # the jump is set to the false branch, and changed to the true one if the condition holds
+                if false_index is not None:
+                    body.append(section('GoToFalse', *set_ip(false_index, TapeIndices.START_STACK)))
 
-                cond_result_pos = TapeIndices.START_STACK + declaration_mapper[block.decl_name].position
-
-                def bf_set_ip(new_ip):
-                    return '{}{}+{}'.format(
-                        bf_travel(cond_result_pos, TapeIndices.IP_INDEX),
-                        new_ip,
-                        bf_travel(TapeIndices.IP_INDEX, cond_result_pos))
+                def go_to_true(pos):
+                    return set_ip(true_index, pos, false_index)
 
-                output += '(GoToTrue {}{} [[-]{}{}])'.format(
-                    bf_travel(TapeIndices.START_STACK, cond_result_pos),
-                    '>+<' if false_ip is not None else '',
-                    bf_set_ip(true_ip),
-                    '>-<' if false_ip is not None else '',
-                    bf_travel(cond_result_pos, TapeIndices.START_STACK))
+                cond_result_pos = TapeIndices.START_STACK + declaration_mapper[block.decl_name].position
+                if fused:
+                    body.append(block.cond_block[-1].to_branch_ir(
+                        declaration_mapper, declaration_mapper.stack_size, go_to_true))
 
-                if false_ip is not None:
-                    output += '(GoToFalse >[-<{}>]<)'.format(
-                        bf_set_ip(false_ip))
+                elif is_temp(block.decl_name):
+                    body.append(section('GoToTrue',
+                        travel(TapeIndices.START_STACK, cond_result_pos),
+                        Loop([clear()] + go_to_true(cond_result_pos)),
+                        travel(cond_result_pos, TapeIndices.START_STACK)))
 
-                output += ' {}'.format(bf_travel(cond_result_pos, TapeIndices.START_STACK))
+                else:
+                    # a variable is tested where it is, leaving it as it was. Its element's marker,
+                    # which only the first element lacks, flags that it's zero, and the free cell
+                    # before that is where both cases end up.
+                    marked = addressable_offset(declaration_mapper, block.decl_name) > 0
+                    body.append(section('GoToTrue',
+                        travel(TapeIndices.START_STACK, cond_result_pos),
+                        *(at(-1, Change(1)) if not marked else []),
+                        Loop(go_to_true(cond_result_pos) + [Shift(-1), Change(-1)]),
+                        Shift(-1),
+                        Loop([Change(-1), Shift(-1)]),
+                        Shift(2),
+                        *(at(-1, Change(1)) if marked else []),
+                        travel(cond_result_pos, TapeIndices.START_STACK)))
 
             else:
                 for op in block.ops:
-                    start_bf_length = len(output)
-                    output += op.to_bf(declaration_mapper, declaration_mapper.stack_size)
-                    end_bf_length = len(output)
-                    symbol_table[(start_bf_length, end_bf_length)] = op.coord
+                    body.append(op.to_ir(declaration_mapper, declaration_mapper.stack_size))
 
                 if block.next_index is not None:
-                    new_ip = ip_offset(block.index, block.next_index)
-                    output += format_bf('NextBlock', None, '{}{}+{}'.format(
-                        bf_travel(TapeIndices.START_STACK, TapeIndices.IP_INDEX),
-                        new_ip,
-                        bf_travel(TapeIndices.IP_INDEX, TapeIndices.START_STACK)))
+                    body.append(section('NextBlock', *set_ip(block.next_index, TapeIndices.START_STACK)))
 
-            output += '{}]{}{}] <[<]'.format(
-                bf_travel(TapeIndices.START_STACK, TapeIndices.IP_ZERO_INDICATOR),
-                bf_end_paren,
-                bf_travel(TapeIndices.IP_ZERO_INDICATOR, TapeIndices.KNOWN_ZERO))
+            return body
 
-        output += '{}]'.format(
-            bf_travel(TapeIndices.FIRST_KNOWN_ZERO, TapeIndices.STOP_INDICATOR_INDEX))
+        if dispatch == 'tree':
+            program += self.tree_dispatch(new_blocks_by_index, block_body, start_ip, ip_bits, peephole)
+        else:
+            program += self.linear_dispatch(new_blocks_by_index, block_body, start_ip, ip_offset, peephole)
 
+        symbol_table = OrderedDict()
+        output = render(program, color, symbol_table)
+
+        print('peephole_stats', dict(self.peephole_stats))
         print()
         return output, declaration_mapper, symbol_table, self.static_data, new_blocks_by_index
+
+    def linear_dispatch(self, blocks_by_index, block_body, start_ip, ip_offset, peephole):
+        # the IP holds how many blocks to skip. Every block in turn counts it down, and runs if
+        # it's already zero, after which it sets it to the distance to the next block to run.
+        setup = [
+            travel(TapeIndices.START, TapeIndices.STOP_INDICATOR_INDEX),
+            Change(1),
+            travel(TapeIndices.STOP_INDICATOR_INDEX, TapeIndices.IP_INDEX),
+            section('IPSetup', Breakpoint(), Change(start_ip), Shift(3), Change(1), Shift(1), Change(1), Shift(-4)),
+            travel(TapeIndices.IP_INDEX, TapeIndices.STOP_INDICATOR_INDEX)]
+
+        main_loop = [travel(TapeIndices.STOP_INDICATOR_INDEX, TapeIndices.FIRST_KNOWN_ZERO)]
+
+        print('new_blocks_by_index:')
+        for block_index, block in blocks_by_index.items():
+            print('%d: %s' % (block_index, block.pretty_print()))
+
+            def set_ip(new_index, pos, old_index=None):
+                old_offset = ip_offset(block.index, old_index) if old_index is not None else 0
+                return [
+                    travel(pos, TapeIndices.IP_INDEX),
+                    Change(ip_offset(block.index, new_index) - old_offset),
+                    travel(TapeIndices.IP_INDEX, pos)]
+
+            body = ([travel(TapeIndices.IP_ZERO_INDICATOR, TapeIndices.START_STACK)] + block_body(block, set_ip) +
+                    [travel(TapeIndices.START_STACK, TapeIndices.IP_ZERO_INDICATOR)])
+
+            if peephole:
+                body, removed = optimize_block(body)
+                self.peephole_stats.update(removed)
+
+            main_loop += [
+                travel(TapeIndices.FIRST_KNOWN_ZERO, TapeIndices.STOP_INDICATOR_INDEX),
+                Loop([
+                    travel(TapeIndices.STOP_INDICATOR_INDEX, TapeIndices.IP_INDEX),
+                    section('IPCheck',
+                        Shift(1), Change(1), Shift(-1),
+                        Loop([Change(-1), Shift(1), Change(-1), Shift(1)]),
+                        Shift(3), Loop([Shift(1)]),
+                        travel(TapeIndices.END_IP_WORKSPACE, TapeIndices.IP_ZERO_INDICATOR)),
+                    section('Block', Loop([Change(-1)] + body)),
+                    travel(TapeIndices.IP_ZERO_INDICATOR, TapeIndices.KNOWN_ZERO)]),
+                Shift(-1), Loop([Shift(-1)])]
+
+        main_loop.append(travel(TapeIndices.FIRST_KNOWN_ZERO, TapeIndices.STOP_INDICATOR_INDEX))
+        return setup + [Loop(main_loop)]
+
+    def tree_dispatch(self, blocks_by_index, block_body, start_ip, ip_bits, peephole):
+        # the IP is kept in binary, one bit per cell. The dispatcher branches on each bit from the
+        # highest down, moving it out into a scratch cell to do so, so by the time it reaches a
+        # block every bit is clear and the block only has to set those of the next IP. The scratch
+        # cell and the flag for the other branch are clear again once a branch is done, so every
+        # level shares them.
+        cells = dispatch_cells(ip_bits + 2)
+        scratch_pos, flag_pos, bit_positions = cells[0], cells[1], cells[2:]
+
+        def set_ip(new_index, pos, old_index=0):
+            nodes = []
+            for bit in range(ip_bits):
+                change = ((new_index >> bit) & 1) - (((old_index or 0) >> bit) & 1)
+                if change != 0:
+                    nodes += at(bit_positions[bit] - pos, Change(change))
+            return nodes
+
+        def branch(prefix, bit):
+            # the blocks whose indexes start with prefix, down to bit
+            if bit < 0:
+                block = blocks_by_index[prefix]
+                print('%d: %s' % (prefix, block.pretty_print()))
+                return [section('Block', *block_body(block, set_ip))]
+
+            zero = branch(prefix, bit - 1)
+            if prefix | (1 << bit) >= len(blocks_by_index):
+                # no block has this bit set, so it's already clear
+                return zero
+
+            one = branch(prefix | (1 << bit), bit - 1)
+            bit_pos = bit_positions[bit]
+            return [section('IPBit',
+                travel(TapeIndices.START_STACK, bit_pos),
+                Loop([Change(-1), travel(bit_pos, scratch_pos), Change(1), travel(scratch_pos, bit_pos)]),
+                travel(bit_pos, flag_pos),
+                Change(1),
+                travel(flag_pos, scratch_pos),
+                Loop([Change(-1), travel(scratch_pos, flag_pos), Change(-1), travel(flag_pos, TapeIndices.START_STACK)] +
+                     one + [travel(TapeIndices.START_STACK, scratch_pos)]),
+                travel(scratch_pos, flag_pos),
+                Loop([Change(-1), travel(flag_pos, TapeIndices.START_STACK)] + zero +
+                     [travel(TapeIndices.START_STACK, flag_pos)]),
+                travel(flag_pos, TapeIndices.START_STACK))]
+
+        setup = [
+            travel(TapeIndices.START, TapeIndices.STOP_INDICATOR_INDEX),
+            Change(1),
+            travel(TapeIndices.STOP_INDICATOR_INDEX, TapeIndices.START_STACK),
+            section('IPSetup', Breakpoint(), *set_ip(start_ip, TapeIndices.START_STACK)),
+            travel(TapeIndices.START_STACK, TapeIndices.STOP_INDICATOR_INDEX)]
+
+        print('new_blocks_by_index:')
+        dispatcher = branch(0, ip_bits - 1)
+        if peephole:
+            dispatcher, removed = optimize_block(dispatcher)
+            self.peephole_stats.update(removed)
+
+        return setup + [Loop(
+            [travel(TapeIndices.STOP_INDICATOR_INDEX, TapeIndices.START_STACK)] +
+            dispatcher +
+            [travel(TapeIndices.START_STACK, TapeIndices.STOP_INDICATOR_INDEX)])]
@@ -0,0 +1,174 @@
+from neuron.bf import BrainfuckRuntime, CompiledBrainfuckRuntime
+from neuron.decoder import decode, fold_loops, fuse_offsets, match_brackets
+from neuron.visitor import DeclarationMapper
+
+from unittest import TestCase, mock, skipIf
+
+try:
+    from neuron.batch import BatchBrainfuckRuntime
+except ImportError:
+    BatchBrainfuckRuntime = None
+
+
+class BrainfuckRuntimeTest(TestCase):
+    def execute_bf(self, code, debug=False, runtime_class=BrainfuckRuntime):
+        runtime = runtime_class(DeclarationMapper(set()), '', [], {}, print_tape_sections=False)
+        runtime.execute(code, debug=debug)
+        return runtime
+
+    def test_decode(self):
+        instructions = decode('3>\033[92m(Move {to=x}\033[39m [-]2+')
+
+        self.assertEqual(['>', '[', '-', ']', '+'], [i.op for i in instructions])
+        self.assertEqual([3, 1, 1, 1, 2], [i.count for i in instructions])
+
+    def test_match_brackets(self):
+        jumps = match_brackets(decode('+[>[-]<-]'))
+        self.assertEqual([None, 8, None, 5, None, 3, None, None, 1], jumps)
+
+        with self.assertRaisesRegex(Exception, 'Unmatched "]" at index 3'):
+            match_brackets(decode('+[]]'))
+
+        with self.assertRaisesRegex(Exception, r'Unmatched "\[" at indices 0, 4'):
+            match_brackets(decode('[+[]['))
+
+    def test_fold_loops(self):
+        instructions = fold_loops(decode('[-] 3>[-3<2+6>+3<]3< [3<] [>-<+] [->[-]<]'))
+
+        self.assertEqual(['clear', '>', 'transfer', '<', 'scan', '[', '>', '-', '<', '+', ']', '[', '-', '>', 'clear', '<', ']'],
+                         [i.op for i in instructions])
+        self.assertEqual(((-3, 2), (3, 1)), instructions[2].args)
+        self.assertEqual(-3, instructions[4].count)
+
+    def test_fuse_offsets(self):
+        instructions = fuse_offsets(fold_loops(decode('5>3+5< 2>[-]>.3< 4>2-4+<[-]')))
+
+        self.assertEqual([('+', 3, 5), ('clear', 1, 2), ('.', 1, 3), ('+', 2, 4), ('clear', 1, 3), ('>', 3, 0)],
+                         [(i.op, i.count, i.offset) for i in instructions])
+
+    def test_loops(self):
+        runtime = self.execute_bf('5+[->2+<]>.')
+        self.assertEqual([0, 10], runtime.state.tape[:2])
+        self.assertEqual(chr(10), runtime.state.output)
+
+    def test_fast_engine_matches_debugger(self):
+        code = '+[->+>3+2<]>[-<2+>]2>[-<+>]<.<<.'
+        fast = self.execute_bf(code)
+        debugged = self.execute_bf(code, debug=True)
+
+        self.assertEqual(0, len(fast.history))
+        self.assertEqual(debugged.state.tape, fast.state.tape[:len(debugged.state.tape)])
+        self.assertFalse(any(fast.state.tape[len(debugged.state.tape):]))
+        self.assertEqual(debugged.state.pointer, fast.state.pointer)
+        self.assertEqual(debugged.state.output, fast.state.output)
+
+    def test_undo_step(self):
+        runtime = self.execute_bf('3+>2+.', debug=True)
+        self.assertEqual(4, len(runtime.history))
+
+        runtime.undo_step()
+        self.assertEqual('', runtime.state.output)
+
+        runtime.undo_step()
+        self.assertEqual([3, 0], runtime.state.tape[:2])
+        self.assertEqual(1, runtime.state.pointer)
+
+        runtime.undo_step()
+        runtime.undo_step()
+        self.assertEqual([0, 0], runtime.state.tape[:2])
+        self.assertEqual(0, runtime.state.pointer)
+        self.assertEqual(0, runtime.state.instr_count)
+
+    def test_compiled_runtime(self):
+        # deep enough to need splitting into separate functions
+        code = '+' + '[>+' * 25 + '<-' + ']' * 25 + '3>[-]+[<]>. 2>[-<+3>+2<]<[3<]'
+        interpreted = self.execute_bf(code)
+        compiled = self.execute_bf(code, runtime_class=CompiledBrainfuckRuntime)
+
+        self.assertEqual(interpreted.state.tape, compiled.state.tape)
+        self.assertEqual(interpreted.state.pointer, compiled.state.pointer)
+        self.assertEqual(interpreted.state.output, compiled.state.output)
+
+    def test_hot_loops_run_natively(self):
+        runtime = BrainfuckRuntime(DeclarationMapper(set()), '', [], {}, print_tape_sections=False,
+                                   hot_loop_threshold=2)
+        runtime.execute('2+[>5+[->3+<]<-]2>.2<', debug=True)
+
+        self.assertEqual([0, 0, 30], runtime.state.tape[:3])
+        self.assertEqual(chr(30), runtime.state.output)
+        # each loop gets hot the second time its header runs, and then runs the rest of the way
+        # natively
+        self.assertEqual([4, 1], list(runtime.native_loops.keys()))
+
+        # as a single step in the history
+        for i in range(4):
+            runtime.undo_step()
+        self.assertEqual([1, 0, 15], runtime.state.tape[:3])
+        self.assertEqual(0, runtime.state.pointer)
+
+    def test_hot_loops_stop_for_the_debugger(self):
+        runtime = BrainfuckRuntime(DeclarationMapper(set()), '', [], {}, print_tape_sections=False,
+                                   hot_loop_threshold=2)
+        with mock.patch('builtins.input', return_value='c') as prompt:
+            runtime.execute('3+[>2+.<-]>[-!]', debug=True)
+
+        self.assertEqual([0, 0], runtime.state.tape[:2])
+        self.assertEqual(chr(2) + chr(4) + chr(6), runtime.state.output)
+        # both loops run natively once hot, handing output and breakpoints back to the interpreter,
+        # so every pass still stops at the breakpoint
+        self.assertEqual([1, 9], sorted(runtime.native_loops.keys()))
+        self.assertEqual(6, prompt.call_count)
+
+        # a native run only records the cells it wrote
+        native_steps = [step for step in runtime.history if step.pc == 9 and len(step.changes) > 0]
+        self.assertEqual([[(1, 5)], [(1, 4)], [(1, 3)], [(1, 2)], [(1, 1)]],
+                         [step.changes for step in native_steps])
+
+    def test_bad_pointer(self):
+        # every engine reports the same pointer, at the same place in the code
+        for code, message, step_message in (
+                ('+>2<-', 'Bad tape pointer: -1 at index 4', 'Bad tape pointer: -1 at index 3'),
+                ('+[-<<+>>]', 'Bad tape pointer: -2 at index 8', 'Bad tape pointer: -1 at index 3'),
+                ('>2+<<', 'Bad tape pointer: -1 at index 4', 'Bad tape pointer: -1 at index 4')):
+            for runtime_class in (BrainfuckRuntime, CompiledBrainfuckRuntime):
+                with self.assertRaisesRegex(Exception, message):
+                    self.execute_bf(code, runtime_class=runtime_class)
+
+            # the debugger steps one instruction at a time, so it stops at the one that moved the pointer
+            with self.assertRaisesRegex(Exception, step_message):
+                self.execute_bf(code, debug=True)
+
+            if BatchBrainfuckRuntime is not None:
+                runtime = BatchBrainfuckRuntime(DeclarationMapper(set()), '', [], {})
+                with self.assertRaisesRegex(Exception, message):
+                    runtime.execute(code, [''])
+
+    def test_cell_width(self):
+        code = '3-.>250+[->2+<]>.'
+        for runtime_class in (BrainfuckRuntime, CompiledBrainfuckRuntime):
+            runtime = runtime_class(DeclarationMapper(set()), '', [], {}, cell_bits=8)
+            runtime.execute(code)
+            self.assertEqual([253, 0, 244], list(runtime.state.tape[:3]))
+            self.assertEqual(chr(253) + chr(244), runtime.state.output)
+
+        runtime = BrainfuckRuntime(DeclarationMapper(set()), '', [], {}, cell_bits=8)
+        runtime.execute(code, debug=True)
+        self.assertEqual([253, 0, 244], list(runtime.state.tape[:3]))
+
+        runtime = BrainfuckRuntime(DeclarationMapper(set()), '', [], {}, cell_bits=16)
+        runtime.execute(code)
+        self.assertEqual([65533, 0, 500], list(runtime.state.tape[:3]))
+
+    @skipIf(BatchBrainfuckRuntime is None, 'batch execution needs numpy')
+    def test_batch(self):
+        # echoes its input, adding 1 to each character, and stops at a zero
+        code = ',[+.[-],]'
+        inputs = ['abc', '', 'zz']
+
+        batch = BatchBrainfuckRuntime(DeclarationMapper(set()), '', [], {})
+        batch.execute(code, inputs)
+        self.assertEqual(['bcd', '', '{{'], batch.outputs)
+
+        batch = BatchBrainfuckRuntime(DeclarationMapper(set()), '', [], {}, cell_bits=8)
+        batch.execute('3-[>+<-]>[>2+<-]', ['', ''])
+        self.assertEqual([[0, 0, 250], [0, 0, 250]], batch.tapes[:, :3].tolist())
@@ -0,0 +1,47 @@
+from neuron.ir import Change, Loop, Marker, Shift, Write, clear, render, section
+from neuron.peephole import optimize_block
+
+from unittest import TestCase
+
+
+class PeepholeTest(TestCase):
+    def test_cancel_travels(self):
+        nodes, removed = optimize_block([
+            section('Zero', Shift(6), clear(), Shift(-6)),
+            section('Move', Shift(5), Loop([Change(-1), Shift(3), Change(1), Shift(-3)]), Shift(-5)),
+            section('NextBlock', Shift(0), Change(1))])
+
+        self.assertEqual('(Zero 6>[-]<)(Move [-3>+3<]5<)(NextBlock +)', render(nodes, color=False))
+        self.assertEqual({'Move': 1}, dict(removed))
+
+    def test_cancel_adds(self):
+        nodes, removed = optimize_block([
+            section('SetValue', Shift(2), Change(3), Shift(-2)),
+            section('Add', Shift(2), Change(-2), Shift(-1))])
+
+        self.assertEqual('(SetValue 2>+)(Add <)', render(nodes, color=False))
+        self.assertEqual({'SetValue': 1, 'Add': 2}, dict(removed))
+
+    def test_dead_loops(self):
+        # the second clear and the move out of the cleared cell never run
+        nodes, removed = optimize_block([
+            section('Zero', Shift(1), clear()),
+            section('Zero', clear()),
+            section('Move', Loop([Change(-1), Shift(1), section('Print', Write()), Change(1), Shift(-1)]), Shift(-1))])
+
+        self.assertEqual('(Zero >[-])(Zero )(Move <)', render(nodes, color=False))
+        self.assertEqual({'Zero': 3, 'Move': 7}, dict(removed))
+
+        # nothing is known about cells after a loop that moves the pointer
+        nodes, removed = optimize_block([
+            section('Zero', clear(), Shift(1), Loop([Shift(1)])),
+            section('Zero', Shift(-1), clear())])
+
+        self.assertEqual('(Zero [-]>[>])(Zero <[-])', render(nodes, color=False))
+        self.assertEqual({}, dict(removed))
+
+    def test_bare_nodes(self):
+        nodes, removed = optimize_block([Shift(2), Marker('Zero', [('name', 'x')], ':1', [Shift(-2), clear()])])
+
+        self.assertEqual('(Zero {name=x} [-])', render(nodes, color=False))
+        self.assertEqual({'Block': 1, 'Zero': 1}, dict(removed))
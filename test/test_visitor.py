@@ -1,20 +1,20 @@
 from neuron.bf import BrainfuckRuntime
-from neuron.visitor import BrainfuckCompilerVisitor, EndBlock
+from neuron.visitor import BrainfuckCompilerVisitor, EndBlock, IfBlock, layout_blocks
 from neuron.commands import *
 
 from pycparser import c_parser
-from unittest import TestCase
+from unittest import TestCase, mock
 
 
 class VisitorTest(TestCase):
-    def execute_code(self, source):
+    def execute_code(self, source, **to_bf_options):
         ast = c_parser.CParser().parse(source)
 
         visitor = BrainfuckCompilerVisitor()
         visitor.visit(ast)
-        code, declaration_mapper, symbol_table, static_data, blocks = visitor.to_bf()
+        code, declaration_mapper, symbol_table, static_data, blocks = visitor.to_bf(**to_bf_options)
 
-        runtime = BrainfuckRuntime(declaration_mapper, visitor.declarations, source, symbol_table)
+        runtime = BrainfuckRuntime(declaration_mapper, source, static_data, symbol_table)
         runtime.execute(code)
 
         return code, symbol_table, blocks, visitor, runtime
@@ -30,18 +30,18 @@ class VisitorTest(TestCase):
 
         _, _, blocks, visitor, _ = self.execute_code(source)
 
-        self.assertEqual(set(['x', 'x~0', 'y']), set([d.name for d in visitor.declarations]))
+        self.assertEqual(set(['x', 'y']), set([d.name for d in visitor.declarations]))
 
         main = visitor.functions['main']
         self.assertEqual(0, main[0].index)
 
-        self.assertEqual(2, len(blocks))
-        end_block = blocks[main[0].next_index]
+        # main falls through to the end of the program, so the two are merged
+        self.assertEqual(1, len(blocks))
+        end_block = blocks[0]
         self.assertEqual(EndBlock, type(end_block))
 
-        self.assertEqual(SetValue(name='x~0', value='2', type='int', coord=':4'), main[0].ops[0])
-        self.assertEqual(Zero(name='x', coord=':4'), main[0].ops[1])
-        self.assertEqual(Move(from_name='x~0', to_name='x', coord=':4'), main[0].ops[2])
+        # the constant is set straight into the variable
+        self.assertEqual([SetValue(name='x', value='2', type='int', coord=':4:21'), EndProgram()], end_block.ops)
 
     def test_initlist(self):
         source = """
@@ -72,6 +72,37 @@ class VisitorTest(TestCase):
         *_, runtime = self.execute_code(source)
         self.assertEqual(11, runtime.get_declaration_value('x'))
 
+    def test_constant_folding(self):
+        source = "int main() { int x = 2 * 3 + 5; int y = (3 >= 2) + (2 < 1); }"
+        _, _, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(11, runtime.get_declaration_value('x'))
+        self.assertEqual(1, runtime.get_declaration_value('y'))
+
+        main = visitor.functions['main']
+        self.assertEqual([SetValue(coord=':1:22', name='x', value='11', type='int'),
+                          SetValue(coord=':1:42', name='y', value='1', type='int')], main[0].ops)
+
+    def test_identities(self):
+        source = "int main() { int a = 4; int x = a * 1 + 0; int y = 1 * (0 + a); int z = 0 * a; }"
+        _, _, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(4, runtime.get_declaration_value('x'))
+        self.assertEqual(4, runtime.get_declaration_value('y'))
+        self.assertEqual(0, runtime.get_declaration_value('z'))
+
+        ops = visitor.functions['main'][0].ops
+        self.assertEqual([], [op for op in ops if type(op) in (Add, Multiply)])
+
+    def test_compare_variables(self):
+        source = "int main() { int a = 3; int b = 2; int x = a > b; int y = b >= a; }"
+        *_, runtime = self.execute_code(source)
+        self.assertEqual(1, runtime.get_declaration_value('x'))
+        self.assertEqual(0, runtime.get_declaration_value('y'))
+
+        source = "int main() { int a = 3; int b = 3; int x = a <= b; int y = a < b; }"
+        *_, runtime = self.execute_code(source)
+        self.assertEqual(1, runtime.get_declaration_value('x'))
+        self.assertEqual(0, runtime.get_declaration_value('y'))
+
     def test_greater(self):
         source = "int main() { int x = 3 > 2; }"
         *_, runtime = self.execute_code(source)
@@ -207,7 +238,8 @@ class VisitorTest(TestCase):
 
         *_, visitor, runtime = self.execute_code(source)
 
-        self.assertEqual(set(['x', 'x~0', 'y', 'y~0', 'if', 'if~0', 'y~1', 'if~1', 'y~2']),
+        # x is branched on where it is, without a temp
+        self.assertEqual(set(['x', 'y', 'if', 'if~0']),
                          set([d.name for d in visitor.declarations]))
 
         self.assertEqual(2, runtime.get_declaration_value('x'))
@@ -256,6 +288,57 @@ class VisitorTest(TestCase):
         *_, runtime = self.execute_code(source)
         self.assertEqual(4, runtime.get_declaration_value('y'))
 
+    def test_getchar(self):
+        source = """
+        int main()
+        {
+            char c = getchar();
+            putchar(c + 1);
+        }
+        """
+
+        with mock.patch('builtins.input', return_value='a'):
+            *_, runtime = self.execute_code(source)
+
+        self.assertEqual(ord('a'), runtime.get_declaration_value('c'))
+        self.assertEqual('b', runtime.state.output)
+
+    def test_temp_after_array(self):
+        source = "int main() { int a = 1; int c[3] = {1, 4, 2}; a = a * 3; }"
+        code, symbol_table, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(3, runtime.get_declaration_value('a'))
+
+        # temps hold a single value each, even when named after an array
+        temps = [d for d in visitor.declarations if '~' in d.name]
+        self.assertEqual([1], list(set(d.size for d in temps)))
+
+    def test_temp_after_decl(self):
+        source = "int main() { int b = 2; int a = 1; b = b + a; }"
+        code, symbol_table, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(3, runtime.get_declaration_value('b'))
+
+        # the assignment's temp is named after b, not after the last declaration
+        self.assertEqual(['b~0'], [d.name for d in visitor.declarations if '~' in d.name])
+
+    def test_array_overwrite(self):
+        source = "int main() { int i = 1; int c[3] = {1, 4, 2}; c[i] = 3; c[2] = c[i]; }"
+        code, symbol_table, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual([1, 3, 3], [runtime.get_array_value('c', i) for i in range(3)])
+
+    def test_increment(self):
+        source = "int main() { int a = 5; int b = a++; int c = ++a; a--; --a; int d = a-- + 1; }"
+        code, symbol_table, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(4, runtime.get_declaration_value('a'))
+        self.assertEqual(5, runtime.get_declaration_value('b'))
+        self.assertEqual(7, runtime.get_declaration_value('c'))
+        self.assertEqual(6, runtime.get_declaration_value('d'))
+
+    def test_compound_assignment(self):
+        source = "int main() { int a = 5; int c[2] = {1, 2}; a += 3; a *= 2; a /= c[1]; c[1] += a; }"
+        code, symbol_table, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(8, runtime.get_declaration_value('a'))
+        self.assertEqual([1, 10], [runtime.get_array_value('c', i) for i in range(2)])
+
     def test_addressable_memory(self):
         source = """
         int main()
@@ -270,7 +353,7 @@ class VisitorTest(TestCase):
 
         *_, visitor, runtime = self.execute_code(source)
 
-        self.assertEqual(set(['a', 'b', 'c', 'c~0', 'c~sub~0', 'c~rvalue~0']),
+        self.assertEqual(set(['a', 'b', 'c', 'c~sub~0', 'c~rvalue~0', 'b~sub']),
                          set([d.name for d in visitor.declarations]))
 
         self.assertEqual(4, runtime.get_declaration_value('b'))
@@ -287,7 +370,448 @@ class VisitorTest(TestCase):
 
         *_, visitor, runtime = self.execute_code(source)
 
-        self.assertEqual(set(['a', 'a~0', 'puts~arg~0', 'puts~arg~0~0']),
+        self.assertEqual(set(['a']),
                          set([d.name for d in visitor.declarations]))
 
-        self.assertEqual("abc", runtime.states[0].output)
+        self.assertEqual("abc", runtime.state.output)
+
+    def test_uncolored(self):
+        source = "int main() { int x = 2 * 3; putchar(x); }"
+
+        code, _, _, _, runtime = self.execute_code(source, color=False)
+
+        self.assertNotIn('\033', code)
+        self.assertIn('(SetValue {name=x, value=6, type=int} ', code)
+
+        self.assertEqual(6, runtime.get_declaration_value('x'))
+        self.assertEqual(chr(6), runtime.state.output)
+
+    def test_slot_reuse(self):
+        source = """
+        int main()
+        {
+            int a = 3;
+            int b = 2;
+            int c = 3;
+            int w = a > b;
+            int x = b > a;
+            int y = a >= c;
+            int z = b <= a;
+            int v = a * b;
+            putchar(w + x + y + z);
+        }
+        """
+
+        code, symbol_table, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual([1, 0, 1, 1, 6], [runtime.get_declaration_value(name) for name in 'wxyzv'])
+        self.assertEqual(chr(3), runtime.state.output)
+
+        declaration_mapper = runtime.declaration_mapper
+        temps = [d.name for d in visitor.declarations if '~' in d.name]
+        self.assertLess(declaration_mapper.stack_size, 8)
+        self.assertLess(declaration_mapper.stack_size, len(temps))
+
+        # the argument to putchar is cleared after it's printed, so its cell is shared
+        for name in ('putchar~arg~0~0',):
+            position = declaration_mapper[name].position
+            sharing = [n for n in declaration_mapper.positions
+                       if n != name and declaration_mapper[n].position == position]
+            self.assertNotEqual([], sharing)
+
+    def test_print_temps(self):
+        source = "int main() {{ int a = 64; {} }}".format(' '.join(['putchar(a + 1);'] * 20))
+
+        code, symbol_table, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual('A' * 20, runtime.state.output)
+        self.assertLess(runtime.declaration_mapper.stack_size, 8)
+
+    def test_placement(self):
+        source = "int main() { int u = 1; int a = 7; int b = 9; int c = a * b; int d = c * b; int e = d; }"
+
+        code, _, _, _, runtime = self.execute_code(source)
+        declaration_mapper = runtime.declaration_mapper
+        self.assertLess(declaration_mapper['u'].position, declaration_mapper['b'].position)
+        profile = runtime.profile_declarations(code)
+        self.assertEqual(567, runtime.get_declaration_value('d'))
+        self.assertGreater(profile['b'], profile['u'])
+
+        for placement in ('static', profile):
+            _, _, _, _, runtime = self.execute_code(source, placement=placement)
+            declaration_mapper = runtime.declaration_mapper
+            self.assertEqual(63, runtime.get_declaration_value('c'))
+            self.assertEqual(567, runtime.get_declaration_value('d'))
+
+            # b is used the most, and u least
+            lvalues = sorted('ubcda', key=lambda name: declaration_mapper[name].position)
+            self.assertEqual('b', lvalues[0])
+            self.assertEqual('u', lvalues[-1])
+
+    def test_multiply_constant(self):
+        source = "int main() { int a = 7; int x = a * 50; int y = 3 * (a + 1); }"
+        _, _, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(350, runtime.get_declaration_value('x'))
+        self.assertEqual(24, runtime.get_declaration_value('y'))
+
+        ops = visitor.functions['main'][0].ops
+        self.assertEqual([], [op for op in ops if type(op) == Multiply])
+        self.assertEqual([50, 3], [op.factor for op in ops if type(op) == MultiplyConstant])
+
+    def test_multiply_smaller_operand_first(self):
+        source = "int main() { int a = 7; int x = a * (a > 2); int y = (a > 9) * a; }"
+        _, _, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(7, runtime.get_declaration_value('x'))
+        self.assertEqual(0, runtime.get_declaration_value('y'))
+
+        ops = visitor.functions['main'][0].ops
+        self.assertEqual([('x~b', 'a'), ('y~a', 'a')],
+                         [(op.first_name, op.second_name) for op in ops if type(op) == Multiply])
+
+    def test_divide(self):
+        source = "int main() { int a = 17; int b = 5; int q = a / b; int r = a % b; int s = b / a; int t = 15 % b; }"
+        _, _, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(3, runtime.get_declaration_value('q'))
+        self.assertEqual(2, runtime.get_declaration_value('r'))
+        self.assertEqual(0, runtime.get_declaration_value('s'))
+        self.assertEqual(0, runtime.get_declaration_value('t'))
+
+        source = "int main() { int a = 7; int b = 1; int q = a / b; int r = a % b; }"
+        *_, runtime = self.execute_code(source)
+        self.assertEqual(7, runtime.get_declaration_value('q'))
+        self.assertEqual(0, runtime.get_declaration_value('r'))
+
+    def test_divide_constant(self):
+        source = "int main() { int a = 23; int q = a / 4; int r = (a + 1) % 7; int x = a / 1 + a % 1; int y = 47 / 10 % 3; }"
+        _, _, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(5, runtime.get_declaration_value('q'))
+        self.assertEqual(3, runtime.get_declaration_value('r'))
+        self.assertEqual(23, runtime.get_declaration_value('x'))
+        self.assertEqual(1, runtime.get_declaration_value('y'))
+
+        ops = visitor.functions['main'][0].ops
+        self.assertEqual([], [op for op in ops if type(op) in (Divide, Modulo)])
+        self.assertEqual([4, 7], [op.divisor for op in ops if type(op) in (DivideConstant, ModuloConstant)])
+
+        with self.assertRaisesRegex(Exception, 'Division by zero'):
+            self.execute_code("int main() { int a = 3; int x = a / (3 < 2); }")
+
+    def test_direct_operands(self):
+        source = "int main() { int a = 3; int b = 4; int y = a; int x = a + b * a; x = x + 1; putchar(b); }"
+        _, _, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(3, runtime.get_declaration_value('y'))
+        self.assertEqual(16, runtime.get_declaration_value('x'))
+        self.assertEqual(3, runtime.get_declaration_value('a'))
+        self.assertEqual(4, runtime.get_declaration_value('b'))
+        self.assertEqual(chr(4), runtime.state.output)
+
+        # variables are read where they are, and only the assignment reading its own variable needs a temp
+        ops = visitor.functions['main'][0].ops
+        self.assertEqual([Copy(coord=':1:44', from_name='a', to_name='y'),
+                          Multiply(coord=':1:59', result_name='x~b', first_name='b', second_name='a'),
+                          Add(coord=':1:55', result_name='x', first_name='a', second_name='x~b')],
+                         [op for op in ops if type(op) in (Copy, Multiply, Add)][:3])
+        self.assertEqual(set(['a', 'b', 'x', 'y', 'x~b', 'x~0', 'x~0~b']), set([d.name for d in visitor.declarations]))
+        self.assertEqual(Print(coord=':1:77', output_name='b'), ops[-1])
+
+    def test_common_subexpressions(self):
+        source = """
+        int main()
+        {
+            int a = 3;
+            int b = 4;
+            int c[3] = {5, 6, 7};
+            int i = 2;
+            int x = a * b + b * a;
+            int y = c[i] * c[i];
+            int z = c[i] > a;
+            c[i] = 2;
+            a = 1;
+            int w = c[i] + a * b;
+        }
+        """
+
+        _, _, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual([24, 49, 1, 6], [runtime.get_declaration_value(name) for name in 'xyzw'])
+
+        # the second product and the second and third array reads are copied, the last of them from
+        # the copy the multiplication left intact. Both c and a change before w is computed.
+        ops = visitor.functions['main'][0].ops
+        self.assertEqual(3, len([op for op in ops if type(op) == Multiply]))
+        self.assertEqual(2, len([op for op in ops if type(op) == GetAddressableValue]))
+        self.assertEqual([('x~a', 'x~b'), ('y~a', 'y~b'), ('y~b', 'z~a')],
+                         [(op.from_name, op.to_name) for op in ops if type(op) == Copy])
+
+    def test_assign_after_array(self):
+        source = "int main() { int a = 1; int c[3] = {1, 4, 2}; a = ((0 > a) <= (a >= c[1])); c[a] = 3; }"
+        code, symbol_table, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual(1, runtime.get_declaration_value('a'))
+        self.assertEqual([1, 3, 2], [runtime.get_array_value('c', i) for i in range(3)])
+
+        # the assignment's temps are named after a, and hold a single value each
+        temps = [d for d in visitor.declarations if '~' in d.name and not d.name.startswith('c~')]
+        self.assertEqual(['a~0', 'a~0~a', 'a~0~a~a', 'a~0~b', 'a~0~b~b', 'a~0~b~b~sub'], sorted(d.name for d in temps))
+        self.assertEqual([1], list(set(d.size for d in temps)))
+
+    def test_dead_code(self):
+        source = "int main() { int x = 1; x = 2; int y = x * 3; if (0) { y = 5; } else { x = 4; } int z = 0; }"
+        _, _, blocks, visitor, runtime = self.execute_code(source)
+        self.assertEqual([4, 6, 0], [runtime.get_declaration_value(name) for name in 'xyz'])
+
+        # the first store to x is overwritten before it's read, z is already zero, and the if always
+        # takes its false branch, so the true branch is never reached
+        ops = [op for block in visitor.blocks_by_index.values() for op in block.ops]
+        self.assertEqual([('x', '2'), ('x', '4')], [(op.name, op.value) for op in ops if type(op) == SetValue])
+        self.assertEqual([], [op for op in ops if type(op) == Zero])
+        self.assertEqual([], [block for block in visitor.blocks_by_index.values() if isinstance(block, IfBlock)])
+
+    def test_tree_dispatch(self):
+        source = """
+        int main()
+        {
+            int a = 3;
+            int b = 0;
+            if (a > 1) { b = 1; } else { b = 2; }
+            if (a > 2) { b = b * 5; }
+            if (a > 3) { b = 7; } else { if (b > 4) { putchar(b + 60); } else { b = 9; } }
+        }
+        """
+
+        _, _, blocks, _, linear = self.execute_code(source, dispatch='linear')
+        _, _, _, _, tree = self.execute_code(source, dispatch='tree')
+        self.assertGreater(len(blocks), 8)
+        for runtime in (linear, tree):
+            self.assertEqual(5, runtime.get_declaration_value('b'))
+            self.assertEqual('A', runtime.state.output)
+
+        # each jump branches on four bits rather than counting past every block
+        self.assertLess(tree.state.instr_count, linear.state.instr_count)
+
+    def test_block_layout(self):
+        source = """
+        int main()
+        {
+            int a = 3;
+            int b = 0;
+            if (a > 1) { b = 1; } else { b = 2; }
+            if (a > 2) { b = b * 5; }
+            putchar(b + 60);
+        }
+        """
+
+        _, _, blocks, _, runtime = self.execute_code(source, merge=False, layout=True)
+        _, _, _, _, unordered = self.execute_code(source, merge=False, layout=False)
+        self.assertEqual('A', runtime.state.output)
+        self.assertLess(runtime.state.instr_count, unordered.state.instr_count)
+
+        # every if is followed by its true branch
+        for index, block in blocks.items():
+            if isinstance(block, IfBlock):
+                self.assertEqual(index + 1, block.true_blocks[0])
+
+        # unless the false one stays in a loop the true one leaves
+        self.assertEqual([0, 1, 2, 4], layout_blocks({0: [1], 1: [4, 2], 2: [1], 4: []}, 0))
+
+    def test_merge_blocks(self):
+        source = """
+        int main()
+        {
+            int a = 3;
+            int b = 0;
+            int c = 0;
+            if (a > 1) { b = 1; } else { b = 2; }
+            c = 4;
+            if (a > 2) { b = b * 5; }
+            putchar(b + c + 56);
+        }
+        """
+
+        _, _, blocks, _, runtime = self.execute_code(source, merge=True)
+        _, _, unmerged_blocks, _, unmerged = self.execute_code(source, merge=False)
+        for r in (runtime, unmerged):
+            self.assertEqual(5, r.get_declaration_value('b'))
+            self.assertEqual('A', r.state.output)
+        self.assertLess(len(blocks), len(unmerged_blocks))
+        self.assertLess(runtime.state.instr_count, unmerged.state.instr_count)
+
+        # each branch of the first if is merged into a copy of the second, after its store to b
+        ifs = [block for block in blocks.values() if isinstance(block, IfBlock)]
+        self.assertEqual(3, len(ifs))
+        self.assertEqual([['b', 'c'], ['b', 'c']],
+                         [[op.name for op in block.cond_block[:2]] for block in ifs if block.decl_name == 'if~1'])
+
+    def test_branch_in_place(self):
+        source = """
+        int main()
+        {
+            int a = 0;
+            int b = 3;
+            int c = 0;
+            int d = 0;
+            int e[2] = {7, 8};
+            if (a) { c = 1; } else { c = 2; }
+            if (b) { d = 4; } else { d = 5; }
+            if (b > 2) { a = 6; }
+            putchar(e[1] + 57);
+        }
+        """
+
+        for dispatch in ('linear', 'tree'):
+            code, _, blocks, visitor, runtime = self.execute_code(source, color=False, dispatch=dispatch)
+
+            # the variables are left as they were, and so are the markers the array read relies on
+            self.assertEqual([6, 3, 2, 4], [runtime.get_declaration_value(name) for name in 'abcd'])
+            self.assertEqual('A', runtime.state.output)
+
+            # only a and b are tested after the fact; the comparison jumps from its own gadget
+            self.assertEqual(['if', 'if~0', 'if~0~b'], [d.name for d in visitor.declarations if d.name.startswith('if')])
+            ifs = [block.decl_name for block in blocks.values() if isinstance(block, IfBlock)]
+            self.assertIn('if~0', ifs)
+            self.assertEqual(len([name for name in ifs if name in 'ab']), code.count('(GoToTrue'))
+
+    def test_loops(self):
+        simple_source = """
+        int main()
+        {
+            int i = 0;
+            int s = 0;
+            while (i < 5) {
+                s += i;
+                i++;
+            }
+            int p = i++;
+            int q = ++i;
+            int f = 1;
+            for (int j = 1; j <= 4; j++)
+                f *= j;
+            int d = 3;
+            int n = 0;
+            do {
+                n += 2;
+                putchar(n + 48);
+                d--;
+            } while (d);
+        }
+        """
+
+        nested_source = """
+        int main()
+        {
+            int k = 0;
+            int c = 0;
+            while (k < 6) {
+                if (k % 2) { c = c + 1; }
+                k++;
+            }
+            int t = 0;
+            for (int a = 0; a < 3; a++)
+                for (int b = 0; b < 2; b++)
+                    t++;
+            int e[3] = {1, 2, 3};
+            for (int m = 0; m < 3; m++)
+                e[m] += m;
+            putchar(e[2] + 48);
+        }
+        """
+
+        for dispatch in ('linear', 'tree'):
+            values = {}
+            output = ''
+            loops = []
+            for source in (simple_source, nested_source):
+                _, _, blocks, _, runtime = self.execute_code(source, color=False, dispatch=dispatch)
+
+                values.update((name, runtime.get_declaration_value(name)) for name in runtime.declaration_mapper.positions)
+                output += runtime.state.output
+                ops = [op for block in blocks.values()
+                       for op in (block.cond_block if isinstance(block, IfBlock) else block.ops)]
+                loops += [op for op in ops if type(op) == WhileLoop]
+
+            self.assertEqual([7, 10, 5, 7, 24, 0, 6], [values[name] for name in 'ispqfdn'])
+            self.assertEqual([6, 3, 6], [values[name] for name in 'kct'])
+            self.assertEqual('2465', output)
+
+            # only the loop with an if in it goes through the dispatcher, testing its condition in
+            # an if block; the rest stay in native loops, the inner for inside the outer one
+            self.assertEqual(['do~0', 'for~0', 'for~1', 'for~2', 'while~0'], sorted(op.cond_name for op in loops))
+            outer = [op for op in loops if op.cond_name == 'for~1'][0]
+            self.assertEqual(['for~0'], [op.cond_name for op in outer.body_ops if type(op) == WhileLoop])
+            self.assertIn('while~0', [block.decl_name for block in blocks.values() if isinstance(block, IfBlock)])
+
+    def test_nested_loop_temps(self):
+        source = """
+        int main()
+        {
+            int s = 0;
+            int i;
+            int j;
+            int k;
+            for (i = 0; i < 2; i++)
+                for (j = 0; j < 3; j++)
+                    for (k = 0; k < 2; k++)
+                        s += (i * j) > k;
+        }
+        """
+
+        *_, runtime = self.execute_code(source, color=False)
+
+        self.assertEqual(3, runtime.get_declaration_value('s'))
+
+        # each loop's condition is only live between computing it and testing it, so the inner
+        # loops' temps share cells with the outer ones'
+        self.assertEqual(2, runtime.declaration_mapper.stack_size)
+
+    def test_temp_clears_kept(self):
+        source = """
+        int main()
+        {
+            int a = 1;
+            int b = 2;
+            int c[3] = {3, 3, 2};
+            b = (((a > 0) < (b >= 0)) + ((a * 2) > (b <= 0))) > ((a < 0) + (b > 0));
+            a = c[0];
+        }
+        """
+
+        stack_sizes = []
+        for dce in (True, False):
+            *_, runtime = self.execute_code(source, color=False, dce=dce)
+
+            self.assertEqual(3, runtime.get_declaration_value('a'))
+            self.assertEqual(0, runtime.get_declaration_value('b'))
+            self.assertEqual([3, 3, 2], [runtime.get_array_value('c', i) for i in range(3)])
+
+            stack_sizes.append(runtime.declaration_mapper.stack_size)
+
+        # setting a temp to 0 is what lets it share a cell, even when it's already 0
+        self.assertEqual(stack_sizes[1], stack_sizes[0])
+
+    def test_stack_overflow(self):
+        expression = 'b'
+        for i in range(9):
+            expression = '((a + {}) > {})'.format(i, expression)
+        source = 'int main() {{ int a = 1; int b = 2; b = {}; }}'.format(expression)
+
+        visitor = BrainfuckCompilerVisitor()
+        visitor.visit(c_parser.CParser().parse(source))
+        with self.assertRaisesRegex(Exception, 'stack cells'):
+            visitor.to_bf(color=False)
+
+    def test_array_to_array(self):
+        statements = [
+            ('arr[2] = arr[0];', [4, 5, 4]),
+            ('arr[1] = arr[0] + 1;', [4, 5, 6]),
+            ('arr[0] = arr[2] / 3;', [2, 5, 6]),
+            ('arr[i + 1] = arr[i * 1];', [4, 5, 5]),
+            ('arr[arr[0] / 2] = arr[i] * 2;', [4, 5, 10]),
+        ]
+
+        for statement, expected in statements:
+            source = "int main() {{ int i = 1; int arr[3] = {{4, 5, 6}}; {} }}".format(statement)
+            *_, runtime = self.execute_code(source)
+            self.assertEqual(expected, [runtime.get_array_value('arr', i) for i in range(3)], statement)
+
+    def test_break_and_continue(self):
+        for statement in ('break', 'continue'):
+            source = "int main() {{ int i = 0; while (i < 10) {{ i++; {}; }} }}".format(statement)
+            visitor = BrainfuckCompilerVisitor()
+            with self.assertRaisesRegex(Exception, 'Unsupported {} statement'.format(statement)):
+                visitor.visit(c_parser.CParser().parse(source))